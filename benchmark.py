@@ -0,0 +1,628 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from keyword_automaton import tokenize
+
+
+# Offline benchmark of score.py
+# A local HTTP server, in a process of its own, stands in for the Solr select endpoint, and an in-process collection stands in for MongoDB,
+# so every stage (fetch, score, CSV attribution, upload) can be measured on a synthetic corpus, without production services
+# scoring runs through the same functions as a real run, with the options of the command line (--spill, --upload-mode, ...)
+#
+#   python benchmark.py --docs 100000 --keywords 200 --mode keyword --json results.json
+#   python benchmark.py --docs 100000 --mode topic --spill --compact-records --upload-mode diff
+#   python benchmark.py --docs 100000 --baseline results.json --tolerance 0.2
+#
+# with --baseline, the exit code is 1 when any stage is slower than the baseline by more than --tolerance
+
+
+STOP_WORDS = ["de", "la", "del", "los", "en"]
+TOPIC_NAMES = ["climate", "covid", "immigration"]
+KEYWORD_FILES = {
+    "climate": "climate",
+    "covid": "covid19",
+    "immigration": "immigration",
+}
+CSV_DIRECTORIES = {
+    "climate": ["CH_HOW", "CH_IS", "CH_WHAT"],
+    "covid": ["CV_SH", "CV_WA", "CV_WH"],
+    "immigration": ["IM_AR", "IM_HO", "IM_IS"],
+}
+
+clause_pattern = re.compile(r'text:\s*"([^"]*)"')
+pseudo_field_pattern = re.compile(r'^(\w+):exists\(query\(\$(\w+)\)\)$')
+
+
+# ********************************************************************************************************
+# Synthetic corpus
+
+# Generates the keyword lists and the articles of the benchmark
+# 'hit_rate' is the fraction of articles that contain keywords, 'overlap' the chance that one of them
+# also contains keywords of a second topic
+def generate_corpus(num_docs, num_keywords, hit_rate, overlap, seed):
+    rng = random.Random(seed)
+
+    filler = ["w" + str(index) for index in range(5000)]
+
+    keyword_lists = {}
+    for topic in TOPIC_NAMES:
+        vocabulary = [topic[:4] + str(index) for index in range(max(num_keywords // 2, 10))]
+        lines = []
+
+        for index in range(num_keywords):
+            words = rng.sample(vocabulary, rng.randint(1, 3))
+
+            # some lines carry stop words, as in the real Spanish keyword files
+            if len(words) > 1 and rng.random() < 0.3:
+                words.insert(1, rng.choice(STOP_WORDS))
+
+            lines.append(" ".join(words))
+
+        keyword_lists[topic] = lines
+
+    docs = []
+    for index in range(num_docs):
+        words = rng.choices(filler, k=40)
+
+        if rng.random() < hit_rate:
+            topics = [rng.choice(TOPIC_NAMES)]
+            if rng.random() < overlap:
+                topics.append(rng.choice(TOPIC_NAMES))
+
+            for topic in topics:
+                for line in rng.sample(keyword_lists[topic], min(3, len(keyword_lists[topic]))):
+                    words.insert(rng.randint(0, len(words)), line)
+
+        docs.append({
+            "id": "https://bench.local/article/" + format(index, "08d"),
+            "title": "Article " + str(index),
+            "timestamp": index,
+            "text": " ".join(words),
+        })
+
+    return keyword_lists, docs
+
+
+# Writes the keyword files and the CSV directories that score.py reads, returns the environment variables for them
+# every article is listed in one of the 3 directories of each topic, some of them in two (the last one wins)
+def write_inputs(workdir, keyword_lists, docs, seed):
+    rng = random.Random(seed)
+    env = {}
+
+    os.makedirs(os.path.join(workdir, "keywords"), exist_ok=True)
+    for topic, lines in keyword_lists.items():
+        for language in ["english", "spanish"]:
+            file_name = os.path.join(workdir, "keywords", KEYWORD_FILES[topic] + "_" + language + ".txt")
+            with open(file_name, "w", encoding='utf-8') as keyword_file:
+                keyword_file.write("\n".join(lines) + "\n")
+
+    for topic, directories in CSV_DIRECTORIES.items():
+        rows = {directory: [] for directory in directories}
+
+        for doc in docs:
+            rows[rng.choice(directories)].append(doc["id"])
+            if rng.random() < 0.05:
+                rows[rng.choice(directories)].append(doc["id"])
+
+        for directory in directories:
+            path = os.path.join(workdir, "csv", directory)
+            os.makedirs(path, exist_ok=True)
+
+            # two CSV files per directory
+            links = rows[directory]
+            half = len(links) // 2
+            for part, part_links in enumerate([links[:half], links[half:]]):
+                with open(os.path.join(path, "part" + str(part) + ".csv"), "w", encoding='utf-8', newline="") as csv_file:
+                    writer = csv.writer(csv_file)
+                    writer.writerow(["link", "desc", "title"])
+                    for link in part_links:
+                        writer.writerow([link, "", link.rsplit("/", 1)[-1]])
+
+            env["path_EN_" + directory] = path
+
+        # the Spanish directories have other names, the benchmark uses the same files for both languages
+        spanish = {
+            "climate": ["CH_AQ", "CH_CO", "CH_ES"],
+            "covid": ["CV_DE", "CV_FU", "CV_QU"],
+            "immigration": ["IM_CO", "IM_LA", "IM_RE"],
+        }[topic]
+        for directory, spanish_directory in zip(directories, spanish):
+            env["path_ES_" + spanish_directory] = env["path_EN_" + directory]
+
+    return env
+
+
+# ********************************************************************************************************
+# Solr stand-in
+
+# In-memory index that answers the queries that score.py sends: AND of text:" ... " phrases, OR of those, and *:*
+class BenchIndex:
+
+    def __init__(self, docs, indexed_tokens):
+        self.docs = docs
+        self.results = {}
+        self.lock = threading.Lock()
+
+        # only the tokens that appear in keywords are indexed, filler words are never queried
+        self.postings = {}
+        for index, doc in enumerate(docs):
+            for token in set(tokenize(doc["text"])):
+                if token in indexed_tokens:
+                    self.postings.setdefault(token, set()).add(index)
+
+    # returns the indexes of the documents that match a query, as a sorted list and as a set
+    def search(self, query):
+        with self.lock:
+            if query in self.results:
+                return self.results[query]
+
+        if query.strip() == "*:*":
+            matches = list(range(len(self.docs)))
+        else:
+            matches = self.match_clauses(query)
+
+        result = (matches, set(matches))
+        with self.lock:
+            self.results[query] = result
+
+        return result
+
+    def match_clauses(self, query):
+        clauses = [tokenize(clause) for clause in clause_pattern.findall(query)]
+        clauses = [clause for clause in clauses if clause]
+        if not clauses:
+            return []
+
+        candidates = None
+        for clause in clauses:
+            for token in clause:
+                postings = self.postings.get(token, set())
+                candidates = set(postings) if candidates is None else candidates & postings
+
+        matches = []
+        for index in sorted(candidates):
+            tokens = tokenize(self.docs[index]["text"])
+            if all(has_phrase(tokens, clause) for clause in clauses):
+                matches.append(index)
+
+        return matches
+
+
+# True when the tokens of 'phrase' appear one after another in 'tokens'
+def has_phrase(tokens, phrase):
+    length = len(phrase)
+    first = phrase[0]
+
+    for start, token in enumerate(tokens):
+        if token == first and tokens[start:start + length] == phrase:
+            return True
+
+    return False
+
+
+# Answers /select and /admin/luke requests the way Solr does, for the parameters that score.py uses
+class SolrHandler(BaseHTTPRequestHandler):
+
+    index = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        self.answer(parsed.path, parse_qs(parsed.query))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        self.answer(urlparse(self.path).path, parse_qs(body))
+
+    def answer(self, path, raw_params):
+        params = {key: values[0] for key, values in raw_params.items()}
+
+        if path.endswith("/admin/luke"):
+            return self.send_body("application/json", json.dumps({"index": {"version": 1}}))
+
+        # topic queries are an OR of keyword queries, each one also sent as a kq_ parameter
+        keyword_params = [key for key in params if key.startswith("kq_")]
+        if keyword_params:
+            matches = sorted(set().union(*(self.index.search(params[key])[1] for key in keyword_params)))
+        else:
+            matches = self.index.search(params.get("q", "*:*"))[0]
+
+        rows = int(params.get("rows", 10))
+        cursor_mark = params.get("cursorMark")
+        start = 0 if cursor_mark in (None, "*") else int(cursor_mark)
+        page = matches[start:start + rows]
+
+        fields = [field for field in params.get("fl", "*").split(",") if field]
+        docs = [self.project(self.index.docs[index], index, fields, params) for index in page]
+
+        if params.get("wt") == "csv":
+            names = [field for field in fields if ":" not in field and field != "*"]
+            lines = [",".join(names)]
+            for doc in docs:
+                lines.append(",".join(csv_value(doc.get(name, "")) for name in names))
+            return self.send_body("text/csv", "\n".join(lines) + "\n")
+
+        response = {"responseHeader": {"status": 0}, "response": {"numFound": len(matches), "start": start, "docs": docs}}
+        if cursor_mark is not None:
+            response["nextCursorMark"] = str(start + len(page)) if page else cursor_mark
+
+        self.send_body("application/json", json.dumps(response))
+
+    def project(self, doc, index, fields, params):
+        projected = {}
+
+        for field in fields:
+            match = pseudo_field_pattern.match(field)
+            if match is not None:
+                projected[match.group(1)] = index in self.index.search(params[match.group(2)])[1]
+            elif field == "*":
+                projected.update(doc)
+            elif field in doc:
+                projected[field] = doc[field]
+
+        return projected
+
+    def send_body(self, content_type, text):
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def csv_value(value):
+    value = str(value)
+    if any(character in value for character in ',"\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+# Builds the index of the Solr stand-in, only the tokens that appear in the keywords are indexed
+def build_index(keyword_lists, docs):
+    indexed_tokens = set()
+    for lines in keyword_lists.values():
+        for line in lines:
+            indexed_tokens.update(tokenize(line))
+
+    return BenchIndex(docs, indexed_tokens)
+
+
+# Serves the Solr stand-in on a free local port, and sends its select URL through 'connection'
+# the corpus is generated again from the same arguments (and seed), so nothing has to be sent to the process
+def serve_solr(corpus_args, connection):
+    index = build_index(*generate_corpus(*corpus_args))
+
+    handler = type("BenchSolrHandler", (SolrHandler,), {"index": index})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+
+    connection.send("http://127.0.0.1:" + str(server.server_address[1]) + "/solr/bench/select")
+    server.serve_forever()
+
+
+# Starts the Solr stand-in in a process of its own, so it doesn't share the GIL nor the memory of the scoring
+# returns the process and its select URL
+def start_solr(corpus_args):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=serve_solr, args=(corpus_args, sender), daemon=True)
+    process.start()
+
+    return process, receiver.recv()
+
+
+# ********************************************************************************************************
+# MongoDB stand-in
+
+# Collection that accepts the writes of score.py and only counts them
+class BenchCollection:
+
+    def __init__(self, name):
+        self.name = name
+        self.written = 0
+
+    def insert_many(self, documents, ordered=True):
+        documents = list(documents)
+        self.written = self.written + len(documents)
+        return SimpleNamespace(inserted_ids=[None] * len(documents))
+
+    def bulk_write(self, requests, ordered=True):
+        self.written = self.written + len(requests)
+        return SimpleNamespace(upserted_count=len(requests), matched_count=0)
+
+    def create_index(self, *args, **kwargs):
+        return "id_1"
+
+    def update_many(self, *args, **kwargs):
+        return SimpleNamespace(modified_count=0)
+
+    # nothing is stored, so every document of a diff upload (MONGO_UPLOAD_MODE=diff) is new
+    def find(self, *args, **kwargs):
+        return iter([])
+
+
+# ********************************************************************************************************
+# Measurements
+
+# Returns the value at 'fraction' of a sorted list
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Resets the peak resident memory of the process, so the peak of the next stage can be read on its own
+# returns False where the peak can't be reset (only Linux can), stages then have no peak of their own
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# Returns the peak resident memory of the process since the last reset, in MB
+def peak_rss_mb():
+    with open("/proc/self/status", "r") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+
+# Returns the measurements of a stage that processed 'items' in 'seconds', with the latencies of its items
+# what wasn't measured for the stage (no latencies, no memory of its own) is None
+def stage_result(name, items, seconds, latencies):
+    result = {
+        "stage": name,
+        "items": items,
+        "seconds": seconds,
+        "items_per_sec": items / seconds if seconds > 0 else 0.0,
+        "peak_rss_mb": None,
+        "peak_traced_mb": None,
+    }
+
+    latencies = sorted(latencies)
+    for key, fraction in [("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)]:
+        result[key] = percentile(latencies, fraction) * 1000 if latencies else None
+
+    return result
+
+
+# Runs a stage and returns its measurements, with the peak resident memory of the process while the stage runs
+# and, with 'trace_memory', the peak of the Python allocations of the stage
+# 'stage' returns the number of items it processed, and may append per item latencies to 'latencies'
+def measure(name, stage, trace_memory):
+    latencies = []
+    own_peak = reset_peak_rss()
+
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    items = stage(latencies)
+    result = stage_result(name, items, time.perf_counter() - start, latencies)
+
+    if own_peak:
+        result["peak_rss_mb"] = peak_rss_mb()
+
+    if trace_memory:
+        result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    return result
+
+
+# Runs score.py against the stand-ins, returns the list of measurements
+# scoring goes through run_scoring_jobs, as in a real run: the query plan, checkpoints, spill files and compact records
+# are all exercised when they are turned on. Its parts are timed with the stage metrics that score.py records
+# ("score" includes the time waiting for Solr, fetching and scoring are interleaved), and every Solr request
+# is timed through send_solr_request, for the "fetch" row. The parts run inside the "scoring" stage, they have
+# neither latencies nor memory of their own
+def run_stages(score, lang, trace_memory):
+    request_latencies = []
+    send_solr_request = score.send_solr_request
+
+    def timed_send_solr_request(*args, **kwargs):
+        start = time.perf_counter()
+        response = send_solr_request(*args, **kwargs)
+        request_latencies.append(time.perf_counter() - start)
+        return response
+
+    score.send_solr_request = timed_send_solr_request
+
+    keyword_lists = score.load_keyword_lists([lang])
+    scored = {}
+
+    def scoring(latencies):
+        score.link_indexes.clear()
+        score.start_checkpoint(False)
+
+        # a single process, so every request goes through the timed send_solr_request
+        results = score.run_scoring_jobs(keyword_lists, [lang], 1)
+        scored.update(results[lang])
+
+        return sum(len(documents_list) for documents_list in scored.values())
+
+    def upload(latencies):
+        del score.upload_stats.latencies[:]
+        items = 0
+
+        for topic in TOPIC_NAMES:
+            score.upload_documents(scored[topic], lang)
+            items = items + len(scored[topic])
+
+        latencies.extend(score.upload_stats.latencies)
+
+        score.remove_spilled(scored)
+        score.finish_checkpoint()
+        return items
+
+    results = [measure("scoring", scoring, trace_memory)]
+
+    results.append(stage_result("fetch", len(request_latencies), sum(request_latencies), request_latencies))
+
+    stages = score.metrics.summary()["stages"]
+    for name in ["score", "link_index", "attribution"]:
+        if name in stages:
+            results.append(stage_result(name, stages[name]["items"], stages[name]["seconds"], []))
+
+    results.append(measure("upload", upload, trace_memory))
+
+    score.send_solr_request = send_solr_request
+    return results
+
+
+# Compares the results with a baseline, returns the stages that are slower by more than 'tolerance'
+def regressions(results, baseline, tolerance):
+    previous = {stage["stage"]: stage for stage in baseline["stages"]}
+    slower = []
+
+    for stage in results:
+        before = previous.get(stage["stage"])
+        if before and before["items_per_sec"] > 0:
+            if stage["items_per_sec"] < before["items_per_sec"] * (1 - tolerance):
+                slower.append(stage["stage"])
+
+    return slower
+
+
+# Formats a measurement, "n/a" when it wasn't measured
+def format_measurement(value, spec):
+    if value is None:
+        return format("n/a", spec[:spec.index(".")] if "." in spec else spec)
+    return format(value, spec)
+
+
+def print_results(results, process_max_rss_mb):
+    print(format("stage", "<12") + format("items", ">10") + format("seconds", ">10") + format("items/s", ">12")
+          + format("p50 ms", ">10") + format("p95 ms", ">10") + format("p99 ms", ">10") + format("peak RSS MB", ">13")
+          + format("traced MB", ">11"))
+
+    for stage in results:
+        print(format(stage["stage"], "<12") + format(stage["items"], ">10") + format(stage["seconds"], ">10.2f")
+              + format(stage["items_per_sec"], ">12.0f") + format_measurement(stage["p50_ms"], ">10.2f")
+              + format_measurement(stage["p95_ms"], ">10.2f") + format_measurement(stage["p99_ms"], ">10.2f")
+              + format_measurement(stage["peak_rss_mb"], ">13.0f") + format_measurement(stage["peak_traced_mb"], ">11.1f"))
+
+    print("max RSS of the benchmark process (whole run, without the Solr stand-in): " + format(process_max_rss_mb, ".0f") + " MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of score.py, against local Solr and MongoDB stand-ins")
+    parser.add_argument("--docs", type=int, default=10000, help="number of synthetic articles (10k to 1M)")
+    parser.add_argument("--keywords", type=int, default=100, help="number of keyword lines per topic")
+    parser.add_argument("--hit-rate", type=float, default=0.3, help="fraction of articles that contain keywords")
+    parser.add_argument("--overlap", type=float, default=0.2, help="chance that a matching article also matches a second topic")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mode", choices=["keyword", "topic", "local"], default="keyword", help="SCORING_MODE")
+    parser.add_argument("--solr-workers", type=int, default=1, help="SOLR_WORKERS")
+    parser.add_argument("--page-size", type=int, default=0, help="SOLR_PAGE_SIZE")
+    parser.add_argument("--response-format", choices=["json", "stream", "csv"], default="json", help="SOLR_RESPONSE_FORMAT")
+    parser.add_argument("--fields", help="SOLR_FIELDS (csv responses need it, they default to id,title,timestamp)")
+    parser.add_argument("--checkpoint-every", type=int, default=50, help="CHECKPOINT_EVERY (0 turns checkpoints off)")
+    parser.add_argument("--spill", action="store_true", help="spill the scored documents to disk (SPILL_DIR)")
+    parser.add_argument("--compact-records", action="store_true", help="COMPACT_RECORDS")
+    parser.add_argument("--upload-mode", choices=["insert", "upsert", "diff"], default="insert", help="MONGO_UPLOAD_MODE")
+    parser.add_argument("--trace-memory", action="store_true", help="also report the peak of Python allocations of each stage")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of a previous run, to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    # the benchmark runs from a temporary directory, output paths are relative to where it was started
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+
+    # the CSV response writer is only used when SOLR_FIELDS is set, without it requests fall back to JSON
+    if args.fields is None:
+        args.fields = "id,title,timestamp" if args.response_format == "csv" else ""
+
+    corpus_args = (args.docs, args.keywords, args.hit_rate, args.overlap, args.seed)
+    solr_process, select_url = start_solr(corpus_args)
+
+    # only the keyword files and CSV directories need the corpus in this process
+    keyword_lists, docs = generate_corpus(*corpus_args)
+    workdir = tempfile.mkdtemp(prefix="score-bench-")
+    os.environ.update(write_inputs(workdir, keyword_lists, docs, args.seed))
+    del docs
+
+    # score.py reads its configuration when it is imported, the keyword files when scoring starts
+    os.environ.update({
+        "SOLR_URL": select_url,
+        "MONGO_URL": "mongodb://127.0.0.1:1",
+        "MONGO_DB": "bench",
+        "MONGO_COLLECTION_EN": "articles_en",
+        "MONGO_COLLECTION_ES": "articles_es",
+        "SCORING_MODE": args.mode,
+        "SOLR_WORKERS": str(args.solr_workers),
+        "SOLR_PAGE_SIZE": str(args.page_size),
+        "SOLR_RESPONSE_FORMAT": args.response_format,
+        "SOLR_FIELDS": args.fields,
+        "SOLR_CACHE": "off",
+        "CHECKPOINT_EVERY": str(args.checkpoint_every),
+        "SPILL_DIR": os.path.join(workdir, "spill") if args.spill else "",
+        "COMPACT_RECORDS": "1" if args.compact_records else "0",
+        "MONGO_UPLOAD_MODE": args.upload_mode,
+    })
+    os.chdir(workdir)
+
+    import score
+
+    score.collection_en = BenchCollection("articles_en")
+    score.collection_es = BenchCollection("articles_es")
+
+    results = run_stages(score, "es", args.trace_memory)
+    solr_process.terminate()
+
+    process_max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print_results(results, process_max_rss_mb)
+
+    report = {
+        "docs": args.docs,
+        "keywords": args.keywords,
+        "mode": args.mode,
+        "solr_workers": args.solr_workers,
+        "page_size": args.page_size,
+        "response_format": args.response_format,
+        "fields": args.fields,
+        "checkpoint_every": args.checkpoint_every,
+        "spill": args.spill,
+        "compact_records": args.compact_records,
+        "upload_mode": args.upload_mode,
+        "process_max_rss_mb": process_max_rss_mb,
+        "stages": results,
+    }
+
+    if args.json:
+        with open(args.json, "w", encoding='utf-8') as json_file:
+            json.dump(report, json_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding='utf-8') as baseline_file:
+            slower = regressions(results, json.load(baseline_file), args.tolerance)
+
+        if slower:
+            print("Slower than the baseline: " + ", ".join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
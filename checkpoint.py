@@ -0,0 +1,84 @@
+import json
+import pickle
+import sqlite3
+import threading
+import zlib
+
+
+# Durable progress of the scoring jobs of a run, stored in a single SQLite file
+# Each job (a topic of a language) saves how many of its units (keywords, or keyword batches) are done,
+# together with the hits found since its previous save. Saves are appended, so the cost of a save doesn't
+# grow with the size of the job, and every save is a single transaction: a crash never leaves half of one
+# The file can be shared by the worker processes of a run, SQLite serializes their writes
+class Checkpoint:
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+
+        # workers of the same run write to the file at the same time, wait for each other's transactions
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS progress (
+                                       job TEXT PRIMARY KEY,
+                                       position INTEGER,
+                                       finished INTEGER)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS deltas (
+                                       job TEXT,
+                                       sequence INTEGER,
+                                       body BLOB,
+                                       PRIMARY KEY (job, sequence))""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS meta (
+                                       key TEXT PRIMARY KEY,
+                                       value TEXT)""")
+        self.connection.commit()
+
+    # returns the number of units of 'job' that are done, whether the job is finished,
+    # and the list of deltas saved by the job, in the order they were saved
+    def load(self, job):
+        with self.lock:
+            row = self.connection.execute("SELECT position, finished FROM progress WHERE job = ?", (job,)).fetchone()
+
+            if row is None:
+                return 0, False, []
+
+            bodies = self.connection.execute("SELECT body FROM deltas WHERE job = ? ORDER BY sequence", (job,)).fetchall()
+
+        return row[0], bool(row[1]), [pickle.loads(zlib.decompress(body)) for (body,) in bodies]
+
+    # saves that the first 'position' units of 'job' are done, with the 'delta' of hits found since the last save
+    def save(self, job, position, delta, finished=False):
+        body = zlib.compress(pickle.dumps(delta, protocol=pickle.HIGHEST_PROTOCOL))
+
+        with self.lock:
+            with self.connection:
+                sequence = self.connection.execute("SELECT COUNT(*) FROM deltas WHERE job = ?", (job,)).fetchone()[0]
+                self.connection.execute("INSERT INTO deltas VALUES (?, ?, ?)", (job, sequence, body))
+                self.connection.execute("INSERT OR REPLACE INTO progress VALUES (?, ?, ?)", (job, position, int(finished)))
+
+    # returns the value saved for 'key' in the metadata of the run, or None
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    # saves a value (anything that can be written as JSON) in the metadata of the run
+    def set_meta(self, key, value):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    # removes every job and the metadata, for a run that starts from scratch
+    def clear(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM progress")
+                self.connection.execute("DELETE FROM deltas")
+                self.connection.execute("DELETE FROM meta")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,141 @@
+import gzip
+import json
+import os
+import time
+
+from metrics import write_atomic
+
+
+# names of the export formats, and the extension of their files
+FORMATS = {"ndjson": ".ndjson.gz", "parquet": ".parquet"}
+
+
+# Writes a chunk of documents as gzip compressed JSON lines
+def write_ndjson(path, documents):
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as output_file:
+        for doc in documents:
+            output_file.write(json.dumps(doc, ensure_ascii=False, default=str) + "\n")
+
+    return []
+
+
+# Writes a chunk of documents as a Parquet file, one column per field
+# fields whose values can't share a column type (e.g. a string in some documents and a list in others)
+# are stored as JSON text, their names are returned so they can be decoded when the file is read
+def write_parquet(path, documents):
+    # imported here, pyarrow is only needed for Parquet exports
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    fields = []
+    for doc in documents:
+        for key in doc:
+            if key not in fields:
+                fields.append(key)
+
+    columns = []
+    json_columns = []
+
+    for field in fields:
+        values = [doc.get(field) for doc in documents]
+
+        try:
+            columns.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            columns.append(pa.array([None if value is None else json.dumps(value, ensure_ascii=False, default=str)
+                                     for value in values], type=pa.string()))
+            json_columns.append(field)
+
+    pq.write_table(pa.Table.from_arrays(columns, names=fields), path, compression="zstd")
+
+    return json_columns
+
+
+# Output sink that streams scored documents to chunked files instead of MongoDB
+# documents are written in chunks of 'chunk_rows', under <directory>/<lang>/<topic>/part-NNNNN.<format>
+# manifest.json lists every finished chunk, with its language, topic and number of documents,
+# and is rewritten after each chunk, so an interrupted export still lists the chunks that are complete
+class ExportSink:
+
+    def __init__(self, directory, file_format="ndjson", chunk_rows=100000):
+        if file_format not in FORMATS:
+            raise ValueError("Unknown export format: " + file_format)
+
+        self.directory = directory
+        self.file_format = file_format
+        self.chunk_rows = chunk_rows
+        self.parts = {}
+        self.manifest = {"format": file_format, "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "files": []}
+
+        os.makedirs(directory, exist_ok=True)
+
+    # writes the scored documents of a topic of a language ("en", or "es")
+    def upload(self, input_list, lang, topic):
+        chunk = []
+
+        for doc in input_list:
+            chunk.append(dict(doc))
+
+            if len(chunk) >= self.chunk_rows:
+                self.write_chunk(chunk, lang, topic)
+                chunk = []
+
+        if chunk:
+            self.write_chunk(chunk, lang, topic)
+
+    def write_chunk(self, documents, lang, topic):
+        part = self.parts.get((lang, topic), 0)
+        self.parts[(lang, topic)] = part + 1
+
+        name = os.path.join(lang, topic, "part-" + format(part, "05d") + FORMATS[self.file_format])
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # written under a temporary name, a chunk is only visible once it is complete
+        temp_path = path + ".tmp"
+        if self.file_format == "parquet":
+            json_columns = write_parquet(temp_path, documents)
+        else:
+            json_columns = write_ndjson(temp_path, documents)
+        os.replace(temp_path, path)
+
+        entry = {"path": name.replace(os.sep, "/"), "lang": lang, "topic": topic, "rows": len(documents),
+                 "bytes": os.path.getsize(path)}
+        if json_columns:
+            entry["json_columns"] = json_columns
+
+        self.manifest["files"].append(entry)
+        write_atomic(os.path.join(self.directory, "manifest.json"), json.dumps(self.manifest, indent=2))
+
+    # nothing is buffered between chunks, every topic is complete once upload() returns
+    def close(self):
+        pass
+
+
+# Returns the manifest of an export directory
+def read_manifest(directory):
+    with open(os.path.join(directory, "manifest.json"), "r", encoding='utf-8') as manifest_file:
+        return json.load(manifest_file)
+
+
+# Yields the documents of a chunk listed in the manifest of an export directory
+def read_chunk(directory, entry, file_format):
+    path = os.path.join(directory, *entry["path"].split("/"))
+
+    if file_format == "parquet":
+        # imported here, pyarrow is only needed for Parquet exports
+        import pyarrow.parquet as pq
+
+        json_columns = set(entry.get("json_columns", []))
+
+        # a row per document, the fields that a document didn't have come back as None
+        for row in pq.read_table(path).to_pylist():
+            doc = {}
+            for key, value in row.items():
+                if value is not None:
+                    doc[key] = json.loads(value) if key in json_columns else value
+            yield doc
+    else:
+        with gzip.open(path, "rt", encoding="utf-8") as input_file:
+            for line in input_file:
+                yield json.loads(line)
@@ -0,0 +1,135 @@
+from array import array
+from itertools import islice
+
+import numpy as np
+
+
+# Sparse document x keyword incidence matrix, kept as two parallel arrays of integer ids (coordinate format)
+# Documents and keywords are interned: each distinct document key and keyword gets a row or column id
+# the first time it is added, so a hit costs two integer appends instead of a dict and a list update
+# Scores, thresholds and the top N documents are computed once, with NumPy, when the matrix is complete
+class IncidenceMatrix:
+
+    def __init__(self):
+        self.row_ids = {}
+        self.rows = []
+        self.column_ids = {}
+        self.columns = []
+        self.hit_rows = array("q")
+        self.hit_columns = array("q")
+
+    def __len__(self):
+        return len(self.rows)
+
+    # number of hits (non zero cells, counting repeated hits of the same cell)
+    @property
+    def hits(self):
+        return len(self.hit_rows)
+
+    # returns the row id of the document with 'key', adding the row with 'value' if it doesn't exist yet
+    def add_row(self, key, value):
+        row = self.row_ids.get(key)
+
+        if row is None:
+            row = self.row_ids[key] = len(self.rows)
+            self.rows.append(value)
+
+        return row
+
+    # returns the column id of 'keyword', adding the column if it doesn't exist yet
+    def add_column(self, keyword):
+        column = self.column_ids.get(keyword)
+
+        if column is None:
+            column = self.column_ids[keyword] = len(self.columns)
+            self.columns.append(keyword)
+
+        return column
+
+    # registers a hit of the keyword 'column' in the document 'row'
+    def add(self, row, column):
+        self.hit_rows.append(row)
+        self.hit_columns.append(column)
+
+    # returns the current size of the matrix, to be passed to delta() later
+    def mark(self):
+        return len(self.rows), len(self.columns), len(self.hit_rows)
+
+    # returns the rows, columns and hits added since 'mark', as plain lists and bytes that can be saved
+    def delta(self, mark):
+        rows, columns, hits = mark
+
+        return (list(islice(self.row_ids, rows, None)), self.rows[rows:], self.columns[columns:],
+                self.hit_rows[hits:].tobytes(), self.hit_columns[hits:].tobytes())
+
+    # adds the rows, columns and hits of a delta, on top of the mark it was taken from
+    def apply(self, delta):
+        keys, rows, columns, hit_rows, hit_columns = delta
+
+        for key, value in zip(keys, rows):
+            self.add_row(key, value)
+
+        for keyword in columns:
+            self.add_column(keyword)
+
+        self.hit_rows.frombytes(hit_rows)
+        self.hit_columns.frombytes(hit_columns)
+
+    # adds the hits of a delta taken from another matrix, after the hits of this one
+    # 'row_map' and 'column_map' give the row id and column id, in this matrix, of every row and column of the delta
+    def add_mapped(self, hit_rows, hit_columns, row_map, column_map):
+        if not hit_rows:
+            return
+
+        rows = np.asarray(row_map, dtype=np.int64)[np.frombuffer(hit_rows, dtype=np.int64)]
+        columns = np.asarray(column_map, dtype=np.int64)[np.frombuffer(hit_columns, dtype=np.int64)]
+
+        self.hit_rows.frombytes(rows.tobytes())
+        self.hit_columns.frombytes(columns.tobytes())
+
+    # returns the hits as NumPy arrays of row ids and column ids, in the order they were added
+    def coordinates(self):
+        return (np.frombuffer(self.hit_rows, dtype=np.int64) if self.hit_rows else np.zeros(0, dtype=np.int64),
+                np.frombuffer(self.hit_columns, dtype=np.int64) if self.hit_columns else np.zeros(0, dtype=np.int64))
+
+    # returns the score of every row: its number of hits, or the sum of the weights of its hits
+    # 'weights' is an array with the weight of each column
+    def scores(self, weights=None):
+        rows, columns = self.coordinates()
+
+        if weights is None:
+            return np.bincount(rows, minlength=len(self.rows))
+
+        weights = np.asarray(weights, dtype=np.float64)
+        scores = np.bincount(rows, weights=weights[columns], minlength=len(self.rows))
+
+        # integral weights give integral scores, kept as integers like the scores without weights
+        if np.all(weights == np.floor(weights)):
+            return scores.astype(np.int64)
+
+        return scores
+
+    # returns the ids of the rows with a score of at least 'threshold', and only the 'top_n' best ones if it is given
+    # rows keep the order they were added in, ties for the last places go to the rows that were added first
+    def select(self, scores, threshold=None, top_n=None):
+        selected = np.arange(len(self.rows))
+
+        if threshold is not None:
+            selected = selected[scores >= threshold]
+
+        if top_n is not None and len(selected) > top_n:
+            best = np.argsort(-scores[selected], kind="stable")[:top_n]
+            selected = np.sort(selected[best])
+
+        return selected
+
+    # returns the column ids of the hits of every row, as CSR arrays: the hits of row i are indices[indptr[i]:indptr[i + 1]]
+    # the hits of each row keep the order they were added in
+    def to_csr(self):
+        rows, columns = self.coordinates()
+
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(len(self.rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.rows)), out=indptr[1:])
+
+        return indptr, columns[order]
@@ -0,0 +1,79 @@
+import re
+from collections import deque
+
+
+# splits a text into lowercase word tokens, the same way for keywords and for articles
+token_pattern = re.compile(r"\w+")
+
+
+# Returns the list of lowercase word tokens of a text
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+
+# Aho-Corasick automaton over word tokens
+# Phrases (tuples of tokens) are added with a value, and a single pass over the tokens
+# of an article finds every phrase that appears in it
+class PhraseAutomaton:
+
+    def __init__(self):
+        # state 0 is the root. goto[state] maps a token to the next state
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+    # adds a phrase (list or tuple of tokens); 'value' is returned when the phrase is found
+    def add(self, phrase, value):
+        state = 0
+
+        for token in phrase:
+            next_state = self.goto[state].get(token)
+
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][token] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+
+            state = next_state
+
+        self.output[state].append(value)
+
+    # computes the failure links, must be called after all phrases have been added
+    def build(self):
+        queue = deque(self.goto[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+
+                # longest proper suffix of the next state that is also a prefix of some phrase
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+
+                fail_state = self.goto[fallback].get(token, 0)
+                if fail_state == next_state:
+                    fail_state = 0
+
+                self.fail[next_state] = fail_state
+                self.output[next_state] = self.output[next_state] + self.output[fail_state]
+
+    # returns the set of values of all the phrases found in 'tokens'
+    def search(self, tokens):
+        found = set()
+        state = 0
+
+        for token in tokens:
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+
+            state = self.goto[state].get(token, 0)
+
+            if self.output[state]:
+                found.update(self.output[state])
+
+        return found
@@ -0,0 +1,154 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# Returns the 64 bit hash of a link, the index stores hashes instead of the links themselves
+# with 64 bits, a collision between two links is unlikely even for hundreds of millions of links
+def link_hash(link):
+    return int.from_bytes(hashlib.blake2b(link.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# Returns a short hex digest of a text, used to name the files of the index
+def name_digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+# Writes a NumPy array to 'path' as raw bytes, replacing the file in a single step
+# the temporary file is unique per process, so workers building the same index don't overwrite each other
+def write_array(path, values):
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    values.tofile(temp_path)
+    os.replace(temp_path, path)
+
+
+# Opens a raw array file written by write_array, mapped in memory (an empty file can't be mapped)
+def map_array(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+# Removes the older versions of a file, that share its 'prefix' but not its name
+def remove_stale(prefix, keep):
+    for path in glob.glob(prefix + "-*"):
+        if not path.endswith(".tmp") and os.path.basename(path) not in keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Returns the links of a CSV file, from its "link" column
+def read_csv_links(file, chunk_size=1000000):
+    # imported here, pandas is only needed when a CSV file has changed
+    import pandas as pd
+
+    # only the link column is read, a chunk of rows at a time
+    for chunk in pd.read_csv(file, usecols=["link"], chunksize=chunk_size):
+        for link in chunk["link"].dropna():
+            yield link
+
+
+# Link -> query index of a list of directories of CSV files, mapped from disk
+# "keys" holds the sorted hashes of every link, "codes" the directory each link was found in
+# a lookup is a binary search, and only the pages it touches are ever read from disk
+class DiskLinkIndex:
+
+    def __init__(self, keys_path, codes_path, queries):
+        self.keys = map_array(keys_path, np.uint64)
+        self.codes = map_array(codes_path, np.uint16)
+        self.queries = queries
+
+    def __len__(self):
+        return len(self.keys)
+
+    # returns the query of 'link', or 'default' if it isn't in any directory
+    def get(self, link, default=None):
+        key = np.uint64(link_hash(link))
+        position = int(np.searchsorted(self.keys, key))
+
+        if position < len(self.keys) and self.keys[position] == key:
+            return self.queries[self.codes[position]]
+
+        return default
+
+
+# Directory of compiled link indexes
+# Every CSV file is compiled into a segment: the sorted hashes of its links. A segment is named after the path,
+# modification time and size of its file, so it is compiled again only when the file changes.
+# The index of a list of directories merges their segments, and is named after all of them: it is merged again
+# only when a segment changes, and no CSV file is read for that
+class LinkIndexStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments_directory = os.path.join(directory, "segments")
+        os.makedirs(self.segments_directory, exist_ok=True)
+
+    # returns the name of the segment of a CSV file, compiling it if the file changed since it was last compiled
+    def segment(self, file):
+        stat = os.stat(file)
+        prefix = name_digest(os.path.abspath(file))
+        name = prefix + "-" + name_digest(str(stat.st_mtime_ns) + ":" + str(stat.st_size)) + ".u64"
+        path = os.path.join(self.segments_directory, name)
+
+        if not os.path.exists(path):
+            hashes = np.fromiter((link_hash(link) for link in read_csv_links(file)), dtype=np.uint64)
+            write_array(path, np.unique(hashes))
+            remove_stale(os.path.join(self.segments_directory, prefix), {name})
+
+        return name
+
+    # returns the index of the 'paths' directories, building or updating it if needed
+    # directories are read in order, so if a link exists in more than one, the last one wins
+    # 'find_files' returns the names of the CSV files of a directory
+    def open(self, paths, find_files):
+        # the query is the name of the directory, on Windows and POSIX paths alike
+        queries = [os.path.basename(os.path.normpath(path)) for path in paths]
+
+        segments = []
+        for path in paths:
+            segments.append(sorted(self.segment(os.path.join(path, name)) for name in find_files(path)))
+
+        prefix = name_digest(json.dumps([os.path.abspath(path) for path in paths]))
+        name = prefix + "-" + name_digest(json.dumps(segments))
+        keys_path = os.path.join(self.directory, name + ".keys")
+        codes_path = os.path.join(self.directory, name + ".codes")
+
+        # the codes are written last, once they exist the index is complete
+        if not os.path.exists(codes_path):
+            self.merge(segments, keys_path, codes_path)
+            remove_stale(os.path.join(self.directory, prefix), {name + ".keys", name + ".codes"})
+
+        return DiskLinkIndex(keys_path, codes_path, queries)
+
+    # merges the segments of every directory into a single sorted array of hashes, with the directory of each one
+    def merge(self, segments, keys_path, codes_path):
+        keys = []
+        codes = []
+
+        for code, names in enumerate(segments):
+            hashes = [np.fromfile(os.path.join(self.segments_directory, name), dtype=np.uint64) for name in names]
+            hashes = np.unique(np.concatenate(hashes)) if hashes else np.zeros(0, dtype=np.uint64)
+
+            keys.append(hashes)
+            codes.append(np.full(len(hashes), code, dtype=np.uint16))
+
+        keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.uint64)
+        codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.uint16)
+
+        # a stable sort keeps the directories of the same link in order, the last one of each run wins
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        codes = codes[order]
+
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+
+        write_array(keys_path, keys[last])
+        write_array(codes_path, codes[last])
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds (seconds) of the histogram buckets, the last bucket (+Inf) is implicit
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# Returns the text of a set of labels, in Prometheus format: {stage="score",lang="es"}
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(key + '="' + str(value).replace('"', '\\"') + '"' for key, value in labels) + "}"
+
+
+# Counters, histograms and stage timings of a run
+# Everything is kept per metric name and set of labels, and can be exported as a JSON summary
+# or as a Prometheus text file (for the node exporter textfile collector)
+class Metrics:
+
+    def __init__(self, prefix="score"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    # adds 'value' to a counter
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # adds an observation to a histogram
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0}
+
+            for index, bound in enumerate(DEFAULT_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][index] = histogram["buckets"][index] + 1
+                    break
+
+            histogram["sum"] = histogram["sum"] + value
+            histogram["count"] = histogram["count"] + 1
+
+    # times a stage of the run: adds its duration and one run to the stage counters
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc("stage_seconds_total", time.perf_counter() - start, stage=name)
+            self.inc("stage_runs_total", 1, stage=name)
+
+    # returns a plain copy of every metric, that can be sent from a worker process and merged in the parent
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                               for key, value in self.histograms.items()},
+            }
+
+    # adds the metrics of a snapshot to these
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+            for key, value in snapshot["histograms"].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0}
+
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], value["buckets"])]
+                histogram["sum"] = histogram["sum"] + value["sum"]
+                histogram["count"] = histogram["count"] + value["count"]
+
+    # returns the JSON summary of the run: per stage totals and rates, counters and histograms
+    def summary(self):
+        snapshot = self.snapshot()
+
+        stages = {}
+        for (name, labels), value in snapshot["counters"].items():
+            if name.startswith("stage_") and labels and labels[0][0] == "stage":
+                stage = stages.setdefault(labels[0][1], {"seconds": 0.0, "runs": 0, "items": 0})
+                stage[name[len("stage_"):-len("_total")]] = value
+
+        for stage in stages.values():
+            stage["items_per_sec"] = stage["items"] / stage["seconds"] if stage["seconds"] > 0 else 0.0
+
+        counters = {name + format_labels(labels): value
+                    for (name, labels), value in sorted(snapshot["counters"].items())}
+
+        histograms = {}
+        for (name, labels), value in sorted(snapshot["histograms"].items()):
+            histograms[name + format_labels(labels)] = {
+                "count": value["count"],
+                "sum": value["sum"],
+                "avg": value["sum"] / value["count"] if value["count"] else 0.0,
+                "buckets": dict(zip([str(bound) for bound in DEFAULT_BUCKETS], value["buckets"])),
+            }
+
+        return {"stages": stages, "counters": counters, "histograms": histograms}
+
+    # returns every metric in the Prometheus text format
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        names = sorted(set(name for name, labels in snapshot["counters"]))
+        for name in names:
+            lines.append("# TYPE " + self.prefix + "_" + name + " counter")
+            for (metric, labels), value in sorted(snapshot["counters"].items()):
+                if metric == name:
+                    lines.append(self.prefix + "_" + name + format_labels(labels) + " " + repr(float(value)))
+
+        names = sorted(set(name for name, labels in snapshot["histograms"]))
+        for name in names:
+            lines.append("# TYPE " + self.prefix + "_" + name + " histogram")
+            for (metric, labels), value in sorted(snapshot["histograms"].items()):
+                if metric != name:
+                    continue
+
+                # Prometheus buckets are cumulative
+                cumulative = 0
+                for bound, count in zip(DEFAULT_BUCKETS, value["buckets"]):
+                    cumulative = cumulative + count
+                    lines.append(self.prefix + "_" + name + "_bucket" + format_labels(labels + (("le", repr(bound)),))
+                                 + " " + str(cumulative))
+
+                lines.append(self.prefix + "_" + name + "_bucket" + format_labels(labels + (("le", "+Inf"),))
+                             + " " + str(value["count"]))
+                lines.append(self.prefix + "_" + name + "_sum" + format_labels(labels) + " " + repr(value["sum"]))
+                lines.append(self.prefix + "_" + name + "_count" + format_labels(labels) + " " + str(value["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    # writes the JSON summary and/or the Prometheus file
+    # files are replaced in a single step, so the node exporter never reads a half written file
+    def export(self, json_path=None, prometheus_path=None):
+        if json_path:
+            write_atomic(json_path, json.dumps(self.summary(), indent=2))
+
+        if prometheus_path:
+            write_atomic(prometheus_path, self.to_prometheus())
+
+
+# Writes 'text' to 'path', replacing the file in a single step
+def write_atomic(path, text):
+    temp_path = path + ".tmp"
+
+    with open(temp_path, "w", encoding='utf-8') as output_file:
+        output_file.write(text)
+
+    os.replace(temp_path, path)
+
+
+# metrics of the current process
+metrics = Metrics()
@@ -1,16 +1,31 @@
 import json
+import re
+import hashlib
 import base64
-from pymongo import MongoClient
+import argparse
 import requests
 import sys
 import itertools
 import os
+import time
+import queue
+import threading
+import socket
 from dotenv import load_dotenv
-from bson.objectid import ObjectId
 from os import listdir
-import pandas as pd
+from collections import deque
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from keyword_automaton import PhraseAutomaton, tokenize
+from solr_cache import SolrCache
+from checkpoint import Checkpoint
+from spill import SpillFile, SpilledDocuments
+from export_sink import ExportSink, read_manifest, read_chunk
+from work_queue import WorkQueue, Heartbeat
+from solr_stream import JsonDocStream, csv_documents
+from solr_throttle import AdaptiveLimiter, CircuitBreaker, backoff_delay
+from metrics import metrics
 from logs import extended_logger
-from merge_duplicates import merger
 
 
 # ******************************************************************************************************** 
@@ -46,79 +61,183 @@ solr_username = os.getenv('SOLR_UNAME')
 solr_password = os.getenv('SOLR_PWD')
 auth_key = os.getenv('auth_key')
 
+# Number of Solr requests that can run at the same time. 1 means that keywords are fetched one after another
+solr_workers = int(os.getenv('SOLR_WORKERS', '1'))
+
+# Seconds to wait for Solr to connect or to send data, and number of times a failed request is retried
+# requests are retried after a timeout, a connection error, or a 429/5xx response, waiting a random time
+# of up to SOLR_BACKOFF * 2^retry seconds (never more than SOLR_BACKOFF_MAX)
+solr_timeout = float(os.getenv('SOLR_TIMEOUT', '60'))
+solr_retries = int(os.getenv('SOLR_RETRIES', '3'))
+solr_backoff = float(os.getenv('SOLR_BACKOFF', '0.5'))
+solr_backoff_max = float(os.getenv('SOLR_BACKOFF_MAX', '30'))
+
+# Responses slower than SOLR_TARGET_LATENCY seconds halve the number of concurrent requests (up to SOLR_WORKERS),
+# fast ones raise it again. After SOLR_BREAKER_FAILURES failed requests in a row no request is sent
+# for SOLR_BREAKER_RESET seconds, then a single one checks whether Solr is back
+solr_target_latency = float(os.getenv('SOLR_TARGET_LATENCY', '5'))
+solr_breaker_failures = int(os.getenv('SOLR_BREAKER_FAILURES', '5'))
+solr_breaker_reset = float(os.getenv('SOLR_BREAKER_RESET', '30'))
+
+# Number of documents per page when paging through results with a cursor. 0 means a single request of 7000 rows
+solr_page_size = int(os.getenv('SOLR_PAGE_SIZE', '0'))
+
+# Fields returned by Solr, comma separated (e.g. id,title,url). Empty means every stored field, including the full text
+# "id" is always added, it is needed to score and to add the query field
+solr_fields = [field.strip() for field in os.getenv('SOLR_FIELDS', '').split(',') if field.strip()]
+
+# When set to 1, scored documents are kept as compact records instead of the dicts returned by Solr
+compact_records = os.getenv('COMPACT_RECORDS', '0') == '1'
+
+# How Solr responses are decoded: "json" decodes each response at once, "stream" decodes the documents one by one
+# while the response downloads, "csv" does the same with the CSV response writer, when SOLR_FIELDS is set
+# (plain stored fields only, every value comes back as a string). Responses are only streamed when SOLR_CACHE is off
+solr_response_format = os.getenv('SOLR_RESPONSE_FORMAT', 'json')
+
+# On-disk cache of Solr responses: "off", "on" (read and write), or "refresh" (fetch again and overwrite)
+solr_cache_mode = os.getenv('SOLR_CACHE', 'off')
+solr_cache_path = os.getenv('SOLR_CACHE_PATH', 'solr_cache.sqlite')
+solr_cache_ttl = int(os.getenv('SOLR_CACHE_TTL', '86400'))
+solr_cache_max_mb = int(os.getenv('SOLR_CACHE_MAX_MB', '1024'))
+
+# Maximum number of clauses in a single Solr query (maxBooleanClauses in solrconfig.xml)
+solr_max_clauses = int(os.getenv('SOLR_MAX_CLAUSES', '1024'))
+
+# Languages scored by main(), comma separated ("en", "es")
+score_languages = [lang.strip() for lang in os.getenv('SCORE_LANGUAGES', 'es').split(',') if lang.strip()]
+
+# Number of processes that score topic/language jobs at the same time. 1 means that jobs run one after another
+scoring_workers = int(os.getenv('SCORING_WORKERS', '1'))
+
+# How keywords are scored: "keyword" sends one query per keyword, "topic" sends the keywords of a topic as OR queries,
+# "local" pulls the corpus of a language once and matches all the keywords locally
+scoring_mode = os.getenv('SCORING_MODE', 'keyword')
+
+# Documents kept for each topic: only those with a score of at least SCORE_THRESHOLD (0 keeps them all),
+# and only the SCORE_TOP_N best ones (0 keeps them all)
+score_threshold = float(os.getenv('SCORE_THRESHOLD', '0'))
+score_top_n = int(os.getenv('SCORE_TOP_N', '0'))
+
+# JSON file that maps keywords to their weight, e.g. {"climate change": 2}. Keywords that aren't in it weigh 1
+# without it, the score of a document is the number of keywords it matched
+keyword_weights_path = os.getenv('KEYWORD_WEIGHTS', '')
+
+# Queries that select the candidate corpus of each language, used in "local" scoring mode (e.g. content_group:20)
+corpus_query_en = os.getenv('CORPUS_QUERY_EN', '*:*')
+corpus_query_es = os.getenv('CORPUS_QUERY_ES', '*:*')
+
 # MongoDB Configuration
 mongodb_client = os.getenv('MONGO_URL')
 mongodb_database = os.getenv('MONGO_DB')
 mongodb_collection_en = os.getenv('MONGO_COLLECTION_EN')
 mongodb_collection_es = os.getenv('MONGO_COLLECTION_ES')
 
-file_climate_english = open("keywords/climate_english.txt","r+", encoding='utf-8')
-file_climate_spanish = open("keywords/climate_spanish.txt","r+", encoding='utf-8')
+# Number of documents sent to MongoDB in a single insert_many
+mongo_batch_size = int(os.getenv('MONGO_BATCH_SIZE', '1000'))
 
-file_covid_english = open("keywords/covid19_english.txt","r+", encoding='utf-8')
-file_covid_spanish = open("keywords/covid19_spanish.txt","r+", encoding='utf-8')
+# Files where the metrics of the run are written at the end of main(): a JSON summary,
+# and a Prometheus text file for the node exporter textfile collector (e.g. /var/lib/node_exporter/score.prom)
+metrics_json_path = os.getenv('METRICS_JSON')
+metrics_prometheus_path = os.getenv('METRICS_PROM')
 
-file_immigration_english = open("keywords/immigration_english.txt","r+", encoding='utf-8')
-file_immigration_spanish = open("keywords/immigration_spanish.txt","r+", encoding='utf-8')
+# When set to 1, only the documents indexed after the last successful run are scored (see WATERMARK_PATH)
+incremental = os.getenv('INCREMENTAL', '0') == '1'
 
-############################################
-# load paths for English articles
+# Solr field with the time (or version) each document was indexed, and the file that keeps the last one scored
+solr_timestamp_field = os.getenv('SOLR_TIMESTAMP_FIELD', 'timestamp')
+watermark_path = os.getenv('WATERMARK_PATH', 'watermark.json')
 
-path_EN_CH_HOW  = os.getenv("path_EN_CH_HOW")
-path_EN_CH_IS   = os.getenv("path_EN_CH_IS")
-path_EN_CH_WHAT = os.getenv("path_EN_CH_WHAT")
+# How scored articles are written: "insert" adds a document per topic (merger() removes the duplicates afterwards),
+# "upsert" keeps a single document per article, that collects the scores of all topics as they are written
+# in every mode, the query of each topic is stored as <prefix>_query, next to its score and found keywords
+# (collections written before that have a single "query" field, the "migrate" command moves it to the per topic fields)
+# "diff" upserts too, but only the articles that are new or whose score, found keywords or query changed: a fingerprint
+# of them is stored with each topic (<prefix>_fingerprint), and compared before writing, so a rerun writes almost nothing
+# incremental runs merge their scores into the existing documents, so they upsert by default
+mongo_upload_mode = os.getenv('MONGO_UPLOAD_MODE', 'upsert' if incremental else 'insert')
 
-path_EN_CV_SH = os.getenv("path_EN_CV_SH")
-path_EN_CV_WA = os.getenv("path_EN_CV_WA")
-path_EN_CV_WH = os.getenv("path_EN_CV_WH")
+# When set to 1, scored articles are uploaded by a background writer while the next topic is being scored
+mongo_background_upload = os.getenv('MONGO_BACKGROUND_UPLOAD', '0') == '1'
 
-path_EN_IM_AR = os.getenv("path_EN_IM_AR")
-path_EN_IM_HO = os.getenv("path_EN_IM_HO")
-path_EN_IM_IS = os.getenv("path_EN_IM_IS")
+# How the link -> query index used to add the query field is kept: "memory" reads every CSV file into a dict
+# on each run, "disk" compiles the CSV files into a memory mapped index in LINK_INDEX_DIR, that is only
+# updated for the files that changed since the last run (see the "index" command)
+link_index_mode = os.getenv('LINK_INDEX', 'memory')
+link_index_dir = os.getenv('LINK_INDEX_DIR', 'link_index')
 
-############################################
-# load paths for Spanish articles
+# Where scored articles go: "mongo" uploads them to MongoDB, "export" writes them to chunked files in EXPORT_DIR
+# (EXPORT_FORMAT "ndjson" for gzip compressed JSON lines, or "parquet"), with EXPORT_CHUNK_ROWS documents per file
+# exported files are loaded into MongoDB later with the "import" command
+output_sink = os.getenv('OUTPUT_SINK', 'mongo')
+export_dir = os.getenv('EXPORT_DIR', 'export')
+export_format = os.getenv('EXPORT_FORMAT', 'ndjson')
+export_chunk_rows = int(os.getenv('EXPORT_CHUNK_ROWS', '100000'))
 
-path_ES_CH_AQ = os.getenv("path_ES_CH_AQ")
-path_ES_CH_CO = os.getenv("path_ES_CH_CO")
-path_ES_CH_ES = os.getenv("path_ES_CH_ES")
+# Directory where the bodies of scored documents are written while a run goes on (low memory mode)
+# only the ids and scores of the documents are kept in memory, their bodies are read back from disk to upload them
+# empty keeps every document in memory
+spill_dir = os.getenv('SPILL_DIR', '')
 
-path_ES_CV_DE = os.getenv("path_ES_CV_DE")
-path_ES_CV_FU = os.getenv("path_ES_CV_FU")
-path_ES_CV_QU = os.getenv("path_ES_CV_QU")
+# When set to 0, keyword queries aren't planned: every keyword sends its own query to Solr
+# with the plan ("keyword" mode, a single process), a query shared by several keywords, topics or languages is sent once,
+# and its documents are kept until the last keyword that needs them: in memory, or in SPILL_DIR when it is set
+query_planning = os.getenv('QUERY_PLAN', '1') == '1'
 
-path_ES_IM_CO = os.getenv("path_ES_IM_CO")
-path_ES_IM_LA = os.getenv("path_ES_IM_LA")
-path_ES_IM_RE = os.getenv("path_ES_IM_RE")
+# File where the progress of the scoring jobs is saved, so an interrupted run can be resumed (--resume)
+# progress is saved every CHECKPOINT_EVERY keywords (and after every OR query in "topic" mode), 0 turns it off
+checkpoint_path = os.getenv('CHECKPOINT_PATH', 'checkpoint.sqlite')
+checkpoint_every = int(os.getenv('CHECKPOINT_EVERY', '50'))
 
-############################################
+# Sharded scoring (the "coordinate", "work" and "reduce" commands): the queue file shared by the coordinator and the workers,
+# the number of keywords of each work item, and the seconds a worker has to finish an item before another one can claim it
+# workers on several hosts need the queue file on shared storage with working file locks
+work_queue_path = os.getenv('WORK_QUEUE', 'work_queue.sqlite')
+work_item_keywords = int(os.getenv('WORK_ITEM_KEYWORDS', '50'))
+work_lease = float(os.getenv('WORK_LEASE', '600'))
 
+# Keyword files of each language and topic, read only when their keywords are needed
+keyword_files = {
+    "en": {
+        "climate": "keywords/climate_english.txt",
+        "covid": "keywords/covid19_english.txt",
+        "immigration": "keywords/immigration_english.txt",
+    },
+    "es": {
+        "climate": "keywords/climate_spanish.txt",
+        "covid": "keywords/covid19_spanish.txt",
+        "immigration": "keywords/immigration_spanish.txt",
+    },
+}
 
-# Establish connection to MongoDB
-try:
-    mongo_client = MongoClient(mongodb_client)
-    extended_logger.info("Connected to MongoDB")
-except Exception as e:
-    extended_logger.error(e)
+# The paths of the CSV files of English and Spanish articles are in environment variables (path_EN_CH_HOW, path_ES_CH_AQ, ...)
+# they are read when the query field is added, see TOPICS and topic_paths()
 
-try:
-    db = mongo_client[mongodb_database]
-    extended_logger.info("Connected to Database")
-except Exception as e:
-    extended_logger.error(e)
-    
-try:
-    collection_en = db[mongodb_collection_en]
-    extended_logger.info("Connected to Collection EN")
-except Exception as e:
-    extended_logger.error(e)
-    
 
-try:
-    collection_es = db[mongodb_collection_es]
-    extended_logger.info("Connected to Collection ES")
-except Exception as e:
-    extended_logger.error(e)
+# MongoDB client and collections, connected the first time they are needed
+# the client keeps a pool of connections, shared by every stage of the run
+mongo_client = None
+collection_en = None
+collection_es = None
+mongo_lock = threading.Lock()
+
+
+# Returns the MongoDB client, connecting the first time it is needed
+def get_mongo_client():
+    global mongo_client
+    
+    with mongo_lock:
+        if mongo_client is None:
+            # imported here, so runs that never touch MongoDB don't pay for it
+            from pymongo import MongoClient
+            
+            try:
+                mongo_client = MongoClient(mongodb_client)
+                extended_logger.info("Connected to MongoDB")
+            except Exception as e:
+                extended_logger.error(e)
+                raise
+    
+    return mongo_client
 
 # ******************************************************************************************************** 
 
@@ -130,6 +249,9 @@ def find_csv_filenames( path_to_dir, suffix=".csv" ):
 
 # creates a dataframe from a CSV file. Input 'file' is of structure C:\\path\\to\\dir\\file.csv
 def df_from_path(file):
+    # imported here, pandas is only needed to add the query field
+    import pandas as pd
+    
     file = file.replace("\\\\","\\")
     
     try:
@@ -157,22 +279,49 @@ def make_list_from_file(input_file):
     return temp_list
 
 
+# Returns the keywords of a topic ("climate", "covid" or "immigration") in a language ("en" or "es")
+def load_keywords(lang, topic):
+    with open(keyword_files[lang][topic], "r", encoding='utf-8') as input_file:
+        return make_list_from_file(input_file)
+
+
 # receive English keyword lists as inputs
 # return 3 separate lists of scored English articles
-def eng_score_routine(climate_input_list, covid_input_list, immigration_input_list):
+# if an uploader is given (a BackgroundUploader or an ExportSink), each list is handed to it as soon as it is scored
+def eng_score_routine(climate_input_list, covid_input_list, immigration_input_list, uploader=None):
+    
+    # score all topics in a single pass over the English corpus
+    if scoring_mode == "local":
+        extended_logger.info("Scoring English articles locally...")
+        articles = local_score_routine(climate_input_list, covid_input_list, immigration_input_list, "en")
+        
+        if uploader is not None:
+            for topic, topic_articles in zip(["climate", "covid", "immigration"], articles):
+                uploader.upload(topic_articles, "en", topic)
+        
+        return articles
     
     #  START WITH CLIMATE KEYWORDS 
     extended_logger.info("Scoring climate articles...")
     climate_articles = climateScoringV2(climate_input_list, "en")
     
+    if uploader is not None:
+        uploader.upload(climate_articles, "en", "climate")
+    
     # CONTINUE WITH COVID KEYWORDS
     extended_logger.info("Scoring covid articles...")
     covid_articles = covidScoringV2(covid_input_list, "en")
     
+    if uploader is not None:
+        uploader.upload(covid_articles, "en", "covid")
+    
     # END WITH IMMIGRATION KEYWORDS
     extended_logger.info("Scoring immigration articles...")
     immigration_articles = immigrationScoringV2(immigration_input_list, "en")
     
+    if uploader is not None:
+        uploader.upload(immigration_articles, "en", "immigration")
+    
     return climate_articles, covid_articles, immigration_articles
 
 
@@ -216,12 +365,12 @@ def queryFromKeywordsList(input_list):
         return ("""text: " """ + input_list[0] + """ " """)
     
 
-# Used in testing, checks how many scrapped documents have been assigned with a query field
-def docChecker(input_list):
+# Used in testing, checks how many scrapped documents have been assigned with the query field of a topic ('prefix')
+def docChecker(input_list, prefix):
     counter = 0
     
     for doc in input_list:
-        if 'query' in doc:
+        if prefix + '_query' in doc:
             counter += 1
             
     return counter
@@ -229,45 +378,394 @@ def docChecker(input_list):
 
 # receive Spanish keyword lists as inputs
 # return 3 separate lists of scored Spanish articles
-def es_score_routine(climate_input_list, covid_input_list, immigration_input_list):
+# if an uploader is given (a BackgroundUploader or an ExportSink), each list is handed to it as soon as it is scored
+def es_score_routine(climate_input_list, covid_input_list, immigration_input_list, uploader=None):
+    # score all topics in a single pass over the Spanish corpus
+    if scoring_mode == "local":
+        extended_logger.info("Scoring Spanish articles locally...")
+        articles = local_score_routine(climate_input_list, covid_input_list, immigration_input_list, "es")
+        
+        if uploader is not None:
+            for topic, topic_articles in zip(["climate", "covid", "immigration"], articles):
+                uploader.upload(topic_articles, "es", topic)
+        
+        return articles
+    
     #  START WITH CLIMATE KEYWORDS 
     extended_logger.info("Scoring Spanish climate articles...")
     climate_articles = climateScoringV2(climate_input_list, "es")
     
+    if uploader is not None:
+        uploader.upload(climate_articles, "es", "climate")
+    
     # CONTINUE WITH COVID KEYWORDS
     extended_logger.info("Scoring Spanish covid articles...")
     covid_articles = covidScoringV2(covid_input_list, "es")
     
+    if uploader is not None:
+        uploader.upload(covid_articles, "es", "covid")
+    
     # END WITH IMMIGRATION KEYWORDS
     extended_logger.info("Scoring Spanish immigration articles...")
     immigration_articles = immigrationScoringV2(immigration_input_list, "es")
     
+    if uploader is not None:
+        uploader.upload(immigration_articles, "es", "immigration")
+    
     return climate_articles, covid_articles, immigration_articles
 
 
-# Receives a list of scored articles. Also receices language input ("en", or "es")
-# Uploads to designated MongoDB collection, based on language
-def upload_documents(input_list, lang):
+# Collects the write latency and the failures of every batch uploaded to MongoDB, for the run summary
+class UploadStats:
+    
+    def __init__(self):
+        self.latencies = []
+        self.inserted = 0
+        self.failed = 0
+        # documents compared with their fingerprint in MongoDB ("diff" upload mode)
+        self.unchanged = 0
+        self.updated = 0
+        self.new = 0
+        self.lock = threading.Lock()
+    
+    # registers a batch that took 'latency' seconds to write
+    def record(self, latency, inserted, failed):
+        with self.lock:
+            self.latencies.append(latency)
+            self.inserted = self.inserted + inserted
+            self.failed = self.failed + failed
+        
+        metrics.observe("mongo_write_seconds", latency)
+        metrics.inc("mongo_documents_written_total", inserted)
+        metrics.inc("mongo_write_failures_total", failed)
+    
+    # registers the documents of a batch that were left as they were, updated, and new
+    def record_diff(self, unchanged, updated, new):
+        with self.lock:
+            self.unchanged = self.unchanged + unchanged
+            self.updated = self.updated + updated
+            self.new = self.new + new
+        
+        metrics.inc("mongo_diff_documents_total", unchanged, result="unchanged")
+        metrics.inc("mongo_diff_documents_total", updated, result="updated")
+        metrics.inc("mongo_diff_documents_total", new, result="new")
+    
+    # writes the summary of all the batches to the log
+    def log_summary(self):
+        if not self.latencies:
+            extended_logger.info("No batches uploaded to MongoDB")
+            return
+        
+        latencies = sorted(self.latencies)
+        average = sum(latencies) / len(latencies)
+        median = latencies[len(latencies) // 2]
+        
+        extended_logger.info("Uploaded " + str(self.inserted) + " documents in " + str(len(latencies)) + " batches, "
+                             + str(self.failed) + " failed")
+        if self.unchanged or self.updated or self.new:
+            extended_logger.info("Compared with MongoDB: " + str(self.unchanged) + " unchanged, " + str(self.updated)
+                                 + " updated, " + str(self.new) + " new")
+        extended_logger.info("Batch write latency (s): avg " + format(average, ".3f") + ", median " + format(median, ".3f")
+                             + ", max " + format(latencies[-1], ".3f"))
+
+
+upload_stats = UploadStats()
+
+
+# Raised at the end of a run when some documents couldn't be written to MongoDB
+# the run is not complete: the watermark isn't moved and the checkpoint is kept, so the run can be resumed
+class UploadFailedError(Exception):
+    pass
+
+
+# Returns the MongoDB collection of a language ("en", or "es"), connecting the first time it is needed
+def get_collection(lang):
+    global collection_en, collection_es
+    
     if lang == "en":
-        for document in input_list:
-            collection_en.insert_one(document)
-    else:
-        for document in input_list:
-            collection_es.insert_one(document)
+        if collection_en is None:
+            collection_en = get_mongo_client()[mongodb_database][mongodb_collection_en]
+            extended_logger.info("Connected to Collection EN")
+        
+        return collection_en
+    
+    if collection_es is None:
+        collection_es = get_mongo_client()[mongodb_database][mongodb_collection_es]
+        extended_logger.info("Connected to Collection ES")
+    
+    return collection_es
 
 
+# Splits a list of documents into consecutive batches of at most 'batch_size' documents
+def iter_batches(input_list, batch_size):
+    # any iterable, spilled documents are read from disk one batch at a time
+    iterator = iter(input_list)
+    batch = list(itertools.islice(iterator, batch_size))
+    
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, batch_size))
 
-# Query Solr Db using the query string input, and returns the JSON document
-def get_solr_data(query):
+
+# Writes a batch of documents with a single unordered insert_many, and records its latency and failures
+# with unordered writes, a failing document (e.g. a duplicate key) doesn't stop the rest of the batch
+def insert_batch(collection, batch):
+    from pymongo.errors import BulkWriteError
     
-    solr_params = {
-        "indent":"true",
-        "q.op":"OR",
-        "q":query,
-        "rows": 7000,
-        "wt":"json"
-    }
+    start = time.perf_counter()
+    
+    try:
+        result = collection.insert_many(batch, ordered=False)
+        inserted = len(result.inserted_ids)
+        failed = 0
+    except BulkWriteError as e:
+        inserted = e.details.get("nInserted", 0)
+        failed = len(e.details.get("writeErrors", []))
+        extended_logger.error("Failed to upload " + str(failed) + " documents of a batch of " + str(len(batch)))
+    
+    upload_stats.record(time.perf_counter() - start, inserted, failed)
+
+
+# Collections that already have the unique index on "id", so it is created only once per run
+indexed_collections = set()
+
+
+# Creates the unique index on "id" that upserts rely on, if it hasn't been created in this run
+def ensure_id_index(collection):
+    if collection.name not in indexed_collections:
+        collection.create_index("id", unique=True)
+        indexed_collections.add(collection.name)
+
+
+# Names of the scored fields of an article (scores, found keywords and query), built the first time they are needed
+scored_field_names = None
+
+
+# Returns the names of the scored fields of an article
+def topic_fields():
+    global scored_field_names
+    
+    if scored_field_names is None:
+        fields = set()
+        for config in TOPICS.values():
+            fields.add(config["prefix"] + "_score")
+            fields.add(config["prefix"] + "_found_keywords")
+            fields.add(config["prefix"] + "_query")
+        
+        scored_field_names = frozenset(fields)
+    
+    return scored_field_names
+
+
+# Returns the fingerprint of the scores of an article: the name of the field it is stored in, and a hash of
+# the fields its upsert sets (score, found keywords and query of the topic, see upsert_fields)
+# the field is named after the topic, so each topic of an article keeps its own
+def score_fingerprint(document):
+    set_fields, insert_fields = upsert_fields(document)
+    prefixes = [config["prefix"] for config in TOPICS.values() if config["prefix"] + "_score" in set_fields]
+    text = json.dumps(set_fields, sort_keys=True, ensure_ascii=False, default=str)
+    
+    return "_".join(prefixes) + "_fingerprint", hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# Splits a scored article into the fields an upsert sets on the existing document (its scores, found keywords
+# and query of each topic), and the rest of the article
+def upsert_fields(document):
+    fields = topic_fields()
+    set_fields = {}
+    insert_fields = {}
+    
+    for key, value in document.items():
+        if key in fields:
+            set_fields[key] = value
+        elif key != "_id":
+            insert_fields[key] = value
+    
+    return set_fields, insert_fields
+
+
+# Returns a document of an older output file (score command, export) in the current schema
+# before the query was stored per topic, every document had a single "query" field: it becomes the <prefix>_query
+# of the topics the document has a score for
+def migrate_query_field(document):
+    if "query" not in document:
+        return document
+    
+    document = dict(document)
+    query = document.pop("query")
+    
+    for config in TOPICS.values():
+        if config["prefix"] + "_score" in document:
+            document.setdefault(config["prefix"] + "_query", query)
+    
+    return document
+
+
+# Returns the upsert of a scored article
+# the scores, found keywords and query of the topic (and the 'extra_fields' given) are set, the rest of the article
+# is only written when it is new, so articles found by several topics end up as a single document with the scores of all of them
+def upsert_from_document(document, extra_fields=None):
+    from pymongo import UpdateOne
+    
+    set_fields, insert_fields = upsert_fields(document)
+    set_fields.update(extra_fields or {})
+    
+    update = {"$set": set_fields}
+    if insert_fields:
+        update["$setOnInsert"] = insert_fields
+    
+    return UpdateOne({"id": document["id"]}, update, upsert=True)
+
+
+# Writes a batch of documents with a single unordered bulk of upserts, and records its latency and failures
+def upsert_batch(collection, batch):
+    from pymongo.errors import BulkWriteError
+    
+    ensure_id_index(collection)
+    start = time.perf_counter()
+    
+    try:
+        result = collection.bulk_write([upsert_from_document(document) for document in batch], ordered=False)
+        written = result.upserted_count + result.matched_count
+        failed = 0
+    except BulkWriteError as e:
+        written = e.details.get("nUpserted", 0) + e.details.get("nMatched", 0)
+        failed = len(e.details.get("writeErrors", []))
+        extended_logger.error("Failed to upsert " + str(failed) + " documents of a batch of " + str(len(batch)))
+    
+    upload_stats.record(time.perf_counter() - start, written, failed)
+
+
+# Upserts the documents of a batch that are new, or whose fingerprint differs from the one stored in MongoDB
+# only the "id" and fingerprint fields of the existing documents are read, the unchanged documents aren't written at all
+def diff_batch(collection, batch):
+    from pymongo.errors import BulkWriteError
+    
+    ensure_id_index(collection)
+    start = time.perf_counter()
     
+    fingerprints = [score_fingerprint(document) for document in batch]
+    projection = dict.fromkeys(set(field for field, _ in fingerprints), 1)
+    projection.update({"id": 1, "_id": 0})
+    
+    stored = {}
+    for existing in collection.find({"id": {"$in": [document["id"] for document in batch]}}, projection):
+        stored[existing["id"]] = existing
+    
+    operations = []
+    unchanged = 0
+    updated = 0
+    new = 0
+    
+    for document, (field, fingerprint) in zip(batch, fingerprints):
+        existing = stored.get(document["id"])
+        
+        if existing is None:
+            new = new + 1
+        elif existing.get(field) == fingerprint:
+            unchanged = unchanged + 1
+            continue
+        else:
+            updated = updated + 1
+        
+        operations.append(upsert_from_document(document, {field: fingerprint}))
+    
+    written = 0
+    failed = 0
+    
+    if operations:
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+            written = result.upserted_count + result.matched_count
+        except BulkWriteError as e:
+            written = e.details.get("nUpserted", 0) + e.details.get("nMatched", 0)
+            failed = len(e.details.get("writeErrors", []))
+            extended_logger.error("Failed to upsert " + str(failed) + " documents of a batch of " + str(len(batch)))
+    
+    upload_stats.record(time.perf_counter() - start, written, failed)
+    upload_stats.record_diff(unchanged, updated, new)
+
+
+# Writes a batch of documents, based on MONGO_UPLOAD_MODE
+def write_batch(collection, batch):
+    with metrics.stage("upload"):
+        if mongo_upload_mode == "diff":
+            diff_batch(collection, batch)
+        elif mongo_upload_mode == "upsert":
+            upsert_batch(collection, batch)
+        else:
+            insert_batch(collection, batch)
+    
+    metrics.inc("stage_items_total", len(batch), stage="upload")
+
+
+# Receives a list of scored articles. Also receices language input ("en", or "es")
+# Uploads to designated MongoDB collection, based on language, in batches of MONGO_BATCH_SIZE documents
+def upload_documents(input_list, lang):
+    collection = get_collection(lang)
+    
+    for batch in iter_batches(input_list, mongo_batch_size):
+        write_batch(collection, batch)
+
+
+# Uploads batches of scored articles from a background thread, so scoring can continue in the meantime
+# at most 'max_pending' batches wait in the queue, after that upload() waits for the writer to catch up
+class BackgroundUploader:
+    
+    def __init__(self, max_pending=8):
+        self.batches = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    # writer loop, stops when it receives None
+    def run(self):
+        while True:
+            item = self.batches.get()
+            
+            if item is None:
+                break
+            
+            collection, batch = item
+            try:
+                write_batch(collection, batch)
+            except Exception as e:
+                # keep the writer alive, the failure is reported in the run summary
+                extended_logger.error(e)
+                upload_stats.record(0, 0, len(batch))
+    
+    # Receives a list of scored articles, the language ("en", or "es") and the topic, and queues them in batches
+    def upload(self, input_list, lang, topic=None):
+        collection = get_collection(lang)
+        
+        for batch in iter_batches(input_list, mongo_batch_size):
+            self.batches.put((collection, batch))
+    
+    # waits until all the queued batches have been written
+    def close(self):
+        self.batches.put(None)
+        self.thread.join()
+
+
+# Shared HTTP session, so connections to Solr are kept alive and reused between requests
+solr_session = None
+
+
+# Returns the shared HTTP session, creating it the first time it is needed
+# its connection pool is as large as the number of concurrent requests
+def get_solr_session():
+    global solr_session
+    
+    if solr_session is None:
+        solr_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(solr_workers, 1))
+        solr_session.mount("http://", adapter)
+        solr_session.mount("https://", adapter)
+    
+    return solr_session
+
+
+# Returns the headers of every Solr request
+def solr_headers():
 
     # Fetch data from Solr with HTTP Basic Authentication
     #auth_header = base64.b64encode(f"{solr_username}:{solr_password}".encode('utf-8')).decode('utf-8')
@@ -279,512 +777,2038 @@ def get_solr_data(query):
         "Authorization": f"Basic {auth_key}"
     }
     
-    response = requests.get(solr_url, params=solr_params, headers=headers)
-    try:
-        solr_data = json.loads(response.text)
-    except:
-        extended_logger.error(query)
-    
-    documents = solr_data['response']['docs']
-    
-    return documents
+    return headers
 
 
-# -------------------- NEW FUNCTIONS START -------------------- #
-# Receives a list containg climate keywords
-# Also receives language ("en" or "es")
-# Returns a list of articles, scored for climate keywords
-def climateScoringV2(climate_input_list, lang):
+# HTTP status codes of a Solr that is overloaded or briefly unavailable, the request is worth retrying
+retry_status_codes = {429, 500, 502, 503, 504}
+
+
+# Raised when Solr still fails after every retry
+class SolrUnavailableError(Exception):
+    pass
+
+
+# Returns a new concurrency limiter and circuit breaker for the Solr requests of this process
+def create_solr_throttle():
+    return (AdaptiveLimiter(max(solr_workers, 1), solr_target_latency),
+            CircuitBreaker(solr_breaker_failures, solr_breaker_reset))
+
+
+# Shared by every Solr request of the process
+solr_limiter, solr_breaker = create_solr_throttle()
+
+
+# Sends a single request to Solr, and returns the HTTP response
+def send_solr_attempt(solr_params, post, stream):
+    headers = solr_headers()
     
-    id_list = []
-    documents_list = [] # this is going to be a large list!
+    if post:
+        # parameters go in the form encoded body
+        headers.pop("Content-Type")
+        return get_solr_session().post(solr_url, data=solr_params, headers=headers, stream=stream, timeout=solr_timeout)
     
-    for item in climate_input_list:
+    return get_solr_session().get(solr_url, params=solr_params, headers=headers, stream=stream, timeout=solr_timeout)
+
+
+# Sends a request to Solr with the 'solr_params' parameters, and returns the HTTP response
+# long requests (many keywords) can be sent as a POST, so they don't hit the URL length limit
+# with 'stream', the body is downloaded while it is being read
+# failed requests are retried (see SOLR_RETRIES), if the last one still gets an error response it is returned,
+# if it gets no response at all SolrUnavailableError is raised
+def send_solr_request(solr_params, post=False, stream=False):
+    for attempt in range(solr_retries + 1):
+        if attempt:
+            metrics.inc("solr_retries_total")
+            time.sleep(delay)
         
-        # split keywords on space key
-        tokens = item.split(" ")
+        # while the circuit is open, wait until it lets a request through
+        # only requests that are sent count as attempts, and at most one is let through per SOLR_BREAKER_RESET
+        wait = solr_breaker.wait_time()
+        while wait > 0:
+            time.sleep(wait)
+            wait = solr_breaker.wait_time()
         
-        # remove de, de la, en, los, etc
-        clean = keywordsCleaner(tokens)
+        solr_limiter.acquire()
+        response = None
+        error = "request failed"
+        start = time.perf_counter()
         
-        query_string = queryFromKeywordsList(clean)
+        try:
+            response = send_solr_attempt(solr_params, post, stream)
+            
+            if response.status_code in retry_status_codes:
+                error = "HTTP " + str(response.status_code)
+            else:
+                error = None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = type(e).__name__
+        except Exception:
+            # not worth a retry, but the circuit must not wait forever for the outcome of this request
+            solr_breaker.record(False)
+            raise
+        finally:
+            # for streamed requests, this is the time until the response starts
+            latency = time.perf_counter() - start
+            solr_limiter.release(latency, error is None)
         
-        # replace "/", "(" and ")" from the query string
-        query_string.replace("/", " ")
-        query_string.replace("(", " ")
-        query_string.replace(")", " ")
+        metrics.observe("solr_request_seconds", latency)
+        metrics.inc("solr_requests_total")
+        if response is None or response.status_code != 200:
+            metrics.inc("solr_errors_total")
         
-        # create a query string from the cleaned keywords list
-        my_query = query_string
+        if solr_breaker.record(error is None):
+            metrics.inc("solr_circuit_opened_total")
+            extended_logger.warning("Too many failed Solr requests, pausing requests for " + str(solr_breaker_reset) + "s")
         
-        documents = get_solr_data(my_query)
+        if error is None:
+            return response
         
-        for doc in documents:
-            # the unique key for each document is the field "doc"
-            key_id = doc["id"]
-            
-            # add the key to the list, if it isn't there yet
-            if key_id not in id_list:
-                id_list.append(key_id)
-                
-                # set score to 1, and add it to the document
-                climate_score = 1
-                
-                doc["climate_score"] = climate_score
-                
-                # update document list of found words
-                climate_list_found_words = []
-                climate_list_found_words.append(item)
-                
-                doc["climate_found_keywords"] = climate_list_found_words
-                
-                # save the updated document to our list
-                documents_list.append(doc)
-                
-            # if the key already exists, we need to update the document
-            else:
-                # found the document with the specific "doc" id
-                # loop all documents...
-                index = 0 # update index after each false iteration
-                for document in documents_list:
-                    # ... and update only the one that we want
-                    if document["id"] == key_id:
-                        
-                        # score already exists, update it
-                        climate_score = document["climate_score"]
-                        climate_score = climate_score + 1
-                        document["climate_score"] = climate_score
-                        
-                        # found words list already exists, update it
-                        climate_list_found_words = document["climate_found_keywords"]
-                        climate_list_found_words.append(item)
-                        document["climate_found_keywords"] = climate_list_found_words
-                        
-                        # document has been modified, update the list
-                        documents_list[index] = document
-                    else:
-                        # this is not the document we are looking for, increase the index
-                        index = index + 1
-    
-    extended_logger.info("Number of Climate scored articles " + str(len(documents_list)))
-    # climate scoring is finished, now let's add the query string to the body of each json item
-    
-    # create lists with the names of each file
-    # each name, is essentially the query that was done for that dataset
-    if lang == "en":
-        filenames_1 = find_csv_filenames(path_EN_CH_HOW)
-        filenames_2 = find_csv_filenames(path_EN_CH_IS)
-        filenames_3 = find_csv_filenames(path_EN_CH_WHAT)
-    else:
-        filenames_1 = find_csv_filenames(path_ES_CH_AQ)
-        filenames_2 = find_csv_filenames(path_ES_CH_CO)
-        filenames_3 = find_csv_filenames(path_ES_CH_ES)
+        extended_logger.warning("Solr request failed (" + error + "), attempt " + str(attempt + 1) + " of " + str(solr_retries + 1))
+        delay = backoff_delay(attempt, solr_backoff, solr_backoff_max)
         
+        # an overloaded Solr may say how long to wait
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        if retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), solr_backoff_max))
+        
+        if response is not None and attempt < solr_retries:
+            response.close()
     
-    # each item in the documents_list has a key labelled "id", which is a web link
-    # this web link is unique
-    # so, for each item in the list, get that link and find where it exists, in which csv file
+    if response is not None:
+        return response
     
-    for doc in documents_list:
-        doc_link = doc["id"]
+    raise SolrUnavailableError("Solr request failed after " + str(solr_retries + 1) + " attempts (" + error + ")")
+
+
+# Response cache and version of the Solr index, both created the first time they are needed
+solr_cache = None
+index_version = None
+solr_cache_lock = threading.Lock()
+
+
+# Returns the response cache, or None when SOLR_CACHE is off
+def get_solr_cache():
+    global solr_cache
     
-        for name in filenames_1:
-            if lang == "en":
-                links_df = df_from_path(path_EN_CH_HOW + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_CH_AQ + "\\" + name)
-        
-            # check if the link exists in the dataframe. If it does, return the filename
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_CH_HOW.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_CH_AQ.split("\\")
-                    doc["query"] = tok[-1]
-                    
-                
-        # if it wasn't in the 1st directory, check the 2nd
-        for name in filenames_2:
-            if lang == "en":
-                links_df = df_from_path(path_EN_CH_IS + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_CH_CO + "\\" + name)
-                
-        
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_CH_IS.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_CH_CO.split("\\")
-                    doc["query"] = tok[-1]
-                    
-                
-        # if it wasn't in the 2nd, it must be on the 3rd. Do a check just in case
-        for name in filenames_3:
-            if lang == "en":
-                links_df = df_from_path(path_EN_CH_WHAT + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_CH_ES + "\\" + name)
-        
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_CH_WHAT.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_CH_ES.split("\\")
-                    doc["query"] = tok[-1]
-                    
-                
-    num = docChecker(documents_list)
-    extended_logger.info("Number of documents with query field: " + str(num))
+    if solr_cache_mode == "off":
+        return None
     
-    # documents list is fully updated now
-    return documents_list
+    with solr_cache_lock:
+        if solr_cache is None:
+            solr_cache = SolrCache(solr_cache_path, solr_cache_ttl, solr_cache_max_mb * 1024 * 1024)
+    
+    return solr_cache
 
 
-# Receives a list containg covid keywords
-# Also receives language ("en" or "es")
-# Returns a list of articles, scored for covid keywords
-def covidScoringV2(covid_input_list, lang):
+# Returns the version of the Solr index, cached responses of any other version are stale
+# the version is asked once per run, from the Luke handler of the core that 'solr_url' belongs to
+def get_index_version():
+    global index_version
+    
+    with solr_cache_lock:
+        if index_version is None:
+            core_url = solr_url.rstrip("/").rsplit("/", 1)[0]
+            
+            try:
+                response = get_solr_session().get(core_url + "/admin/luke", params={"numTerms": 0, "wt": "json"},
+                                                  headers=solr_headers(), timeout=solr_timeout)
+                index_version = str(json.loads(response.text)["index"]["version"])
+            except Exception as e:
+                # without a version we can't tell if an entry is stale, so nothing cached is read in this run
+                extended_logger.error("Could not read the Solr index version, the response cache won't be read: " + str(e))
+                index_version = "unknown-" + str(time.time())
+    
+    return index_version
+
+
+# Returns the cache key of a request: a hash of the Solr URL and its parameters
+# whitespace in the parameters is normalized, so the same query always gets the same key
+def solr_cache_key(solr_params):
+    normalized = {}
+    
+    for key, value in solr_params.items():
+        # "indent" only changes how the response looks
+        if key != "indent":
+            normalized[key] = " ".join(str(value).split())
+    
+    text = solr_url + json.dumps(normalized, sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Filter query added to every request of an incremental run, set by begin_delta_run()
+delta_filter = None
+
+
+# Returns the request parameters with the filter of an incremental run, if there is one
+# in incremental runs, every request only asks for the documents indexed since the last run
+def with_delta_filter(solr_params):
+    if delta_filter is not None and "fq" not in solr_params:
+        return dict(solr_params, fq=delta_filter)
+    
+    return solr_params
+
+
+# True when the documents of a response are decoded one by one while it downloads
+# the response cache stores whole responses, so responses are only streamed when it is off
+def streaming_responses():
+    return solr_response_format != "json" and solr_cache_mode == "off"
+
+
+# Fails if Solr didn't answer a request with a successful response, instead of decoding its error page
+# SolrUnavailableError when Solr was still overloaded or down after every retry, HTTPError for other errors
+# (e.g. 400 for a query Solr can't parse)
+def check_solr_response(response, solr_params):
+    if response.status_code == 200:
+        return
     
-    id_list = []
-    documents_list = [] # this is going to be a large list!
+    extended_logger.error("Solr answered HTTP " + str(response.status_code) + " for query: " + solr_params["q"])
     
-    for item in covid_input_list:
-        # split keywords on space key
-        tokens = item.split(" ")
-        
-        # remove de, de la, en, los, etc
-        clean = keywordsCleaner(tokens)
-        
-        query_string = queryFromKeywordsList(clean)
-        
-        # replace "/", "(" and ")" from the query string
-        query_string.replace("/", " ")
-        query_string.replace("(", " ")
-        query_string.replace(")", " ")
-        
-        # create a query string from the cleaned keywords list
-        my_query = query_string
-        
-        documents = get_solr_data(my_query)
-        
-        for doc in documents:
-            # the unique key for each document is the field "doc"
-            key_id = doc["id"]
-            
-            # add the key to the list, if it isn't there yet
-            if key_id not in id_list:
-                id_list.append(key_id)
-                
-                # set score to 1, and add it to the document
-                covid_score = 1
-                
-                doc["covid_score"] = covid_score
-                
-                # update document list of found words
-                covid_list_found_words = []
-                covid_list_found_words.append(item)
-                
-                doc["covid_found_keywords"] = covid_list_found_words
-                
-                # save the updated document to our list
-                documents_list.append(doc)
-                
-            # if the key already exists, we need to update the document
-            else:
-                # found the document with the specific "doc" id
-                # loop all documents...
-                index = 0 # update index after each false iteration
-                for document in documents_list:
-                    # ... and update only the one that we want
-                    if document["id"] == key_id:
-                        
-                        # score already exists, update it
-                        covid_score = document["covid_score"]
-                        covid_score = covid_score + 1
-                        document["covid_score"] = covid_score
-                        
-                        # found words list already exists, update it
-                        covid_list_found_words = document["covid_found_keywords"]
-                        covid_list_found_words.append(item)
-                        document["covid_found_keywords"] = covid_list_found_words
-                        
-                        # document has been modified, update the list
-                        documents_list[index] = document
-                    else:
-                        # this is not the document we are looking for, increase the index
-                        index = index + 1
-    
-    extended_logger.info("Number of Covid scored articles " + str(len(documents_list)))
-    # COVID scoring is finished, now let's add the query string to the body of each json item
-    
-    # create lists with the names of each file
-    # each name, is essentially the query that was done for that dataset
-    if lang == "en":
-        filenames_1 = find_csv_filenames(path_EN_CV_SH)
-        filenames_2 = find_csv_filenames(path_EN_CV_WA)
-        filenames_3 = find_csv_filenames(path_EN_CV_WH)
-    else:
-        filenames_1 = find_csv_filenames(path_ES_CV_DE)
-        filenames_2 = find_csv_filenames(path_ES_CV_FU)
-        filenames_3 = find_csv_filenames(path_ES_CV_QU)
+    if response.status_code in retry_status_codes:
+        response.close()
+        raise SolrUnavailableError("Solr request failed after " + str(solr_retries + 1) + " attempts (HTTP " + str(response.status_code) + ")")
     
-    # each item in the documents_list has a key labelled "id", which is a web link
-    # this web link is unique
-    # so, for each item in the list, get that link and find where it exists, in which csv file
+    response.raise_for_status()
     
-    for doc in documents_list:
-        doc_link = doc["id"]
+    # a status that requests doesn't count as an error (e.g. a redirect that wasn't followed)
+    raise requests.HTTPError("Unexpected Solr response: HTTP " + str(response.status_code), response=response)
+
+
+# Sends a streamed request to Solr, and fails if Solr didn't answer with a successful response
+def send_streamed_request(solr_params, post=False):
+    response = send_solr_request(with_delta_filter(solr_params), post, stream=True)
+    check_solr_response(response, solr_params)
     
-        for name in filenames_1:
-            if lang == "en":
-                links_df = df_from_path(path_EN_CV_SH + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_CV_DE + "\\" + name)
-        
-            # check if the link exists in the dataframe. If it does, return the filename
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_CV_SH.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_CV_DE.split("\\")
-                    doc["query"] = tok[-1]
-                
-        # if it wasn't in the 1st directory, check the 2nd
-        for name in filenames_2:
-            if lang == "en":
-                links_df = df_from_path(path_EN_CV_WA + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_CV_FU + "\\" + name)
-        
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_CV_WA.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_CV_FU.split("\\")
-                    doc["query"] = tok[-1]
-                
-        # if it wasn't in the 2nd, it must be on the 3rd. Do a check just in case
-        for name in filenames_3:
-            if lang == "en":
-                links_df = df_from_path(path_EN_CV_WH + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_CV_QU + "\\" + name)
-        
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_CV_WH.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_CV_QU.split("\\")
-                    doc["query"] = tok[-1]
+    return response
+
+
+# Sends a request to Solr, and returns a JsonDocStream over its documents
+def solr_doc_stream(solr_params, post=False):
+    return JsonDocStream(send_streamed_request(solr_params, post))
+
+
+# Sends a request to Solr with the CSV response writer, and yields its documents one by one
+def solr_csv_documents(solr_params):
+    solr_params = dict(solr_params, wt="csv")
+    solr_params.pop("indent", None)
     
-                
-    num = docChecker(documents_list)
-    extended_logger.info("Number of documents with query field: " + str(num))
+    response = send_streamed_request(solr_params)
+    metrics.inc("solr_bytes_received_total", int(response.headers.get("Content-Length", 0)))
     
-    # documents list is fully updated now
-    return documents_list
+    return csv_documents(response)
 
 
-# Receives a list containg immigration keywords
-# Also receives language ("en" or "es")
-# Returns a list of articles, scored for immigration keywords
-def immigrationScoringV2(immigration_input_list, lang):
+# Yields the documents of a JsonDocStream, and counts the bytes it received once it has been read
+def counted_documents(stream):
+    for doc in stream:
+        yield doc
+    
+    metrics.inc("solr_bytes_received_total", stream.bytes_received)
+
+
+# Sends a request to Solr with the 'solr_params' parameters, and returns the decoded JSON response
+# when the response cache is on, responses are read from it, and written to it
+# error responses are never cached, they fail the request (see check_solr_response)
+def solr_request(solr_params, post=False):
     
-    id_list = []
-    documents_list = [] # this is going to be a large list!
+    solr_params = with_delta_filter(solr_params)
     
-    for item in immigration_input_list:
-        my_query = """text:" """ + item + """ " """
-        
-        documents = get_solr_data(my_query)
+    cache = get_solr_cache()
+    text = None
+    
+    if cache is not None:
+        key = solr_cache_key(solr_params)
+        version = get_index_version()
         
-        for doc in documents:
-            # the unique key for each document is the field "doc"
-            key_id = doc["id"]
+        if solr_cache_mode != "refresh":
+            text = cache.get(key, version)
             
-            # add the key to the list, if it isn't there yet
-            if key_id not in id_list:
-                id_list.append(key_id)
-                
-                # set score to 1, and add it to the document
-                immigration_score = 1
-                
-                doc["immigration_score"] = immigration_score
-                
-                # update document list of found words
-                immigration_list_found_words = []
-                immigration_list_found_words.append(item)
-                
-                doc["immigration_found_keywords"] = immigration_list_found_words
-                
-                # save the updated document to our list
-                documents_list.append(doc)
-                
-            # if the key already exists, we need to update the document
-            else:
-                # found the document with the specific "doc" id
-                # loop all documents...
-                index = 0 # update index after each false iteration
-                for document in documents_list:
-                    # ... and update only the one that we want
-                    if document["id"] == key_id:
-                        
-                        # score already exists, update it
-                        immigration_score = document["immigration_score"]
-                        immigration_score = immigration_score + 1
-                        document["immigration_score"] = immigration_score
-                        
-                        # found words list already exists, update it
-                        immigration_list_found_words = document["immigration_found_keywords"]
-                        immigration_list_found_words.append(item)
-                        document["immigration_found_keywords"] = immigration_list_found_words
-                        
-                        # document has been modified, update the list
-                        documents_list[index] = document
-                    else:
-                        # this is not the document we are looking for, increase the index
-                        index = index + 1
-    
-    extended_logger.info("Number of immigration scored articles " + str(len(documents_list)))
-    # immigration scoring is finished, now let's add the query string to the body of each json item
-    
-    # create lists with the names of each file
-    # each name, is essentially the query that was done for that dataset
-    if lang == "en":
-        filenames_1 = find_csv_filenames(path_EN_IM_AR)
-        filenames_2 = find_csv_filenames(path_EN_IM_HO)
-        filenames_3 = find_csv_filenames(path_EN_IM_IS)
-    else:
-        filenames_1 = find_csv_filenames(path_ES_IM_CO)
-        filenames_2 = find_csv_filenames(path_ES_IM_LA)
-        filenames_3 = find_csv_filenames(path_ES_IM_RE)
+            if text is not None:
+                metrics.inc("solr_cache_hits_total")
     
-    # each item in the documents_list has a key labelled "id", which is a web link
-    # this web link is unique
-    # so, for each item in the list, get that link and find where it exists, in which csv file
+    if text is None:
+        response = send_solr_request(solr_params, post)
+        check_solr_response(response, solr_params)
+        
+        text = response.text
+        metrics.inc("solr_bytes_received_total", len(response.content))
+        
+        if cache is not None:
+            cache.put(key, version, text)
     
-    for doc in documents_list:
-        doc_link = doc["id"]
+    try:
+        solr_data = json.loads(text)
+    except ValueError:
+        # an error page instead of JSON, the run must stop here instead of scoring an empty response
+        extended_logger.error("Invalid Solr response for query: " + solr_params["q"])
+        raise
     
-        for name in filenames_1:
-            if lang == "en":
-                links_df = df_from_path(path_EN_IM_AR + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_IM_CO + "\\" + name)
-        
-            # check if the link exists in the dataframe. If it does, return the filename
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_IM_AR.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_IM_CO.split("\\")
-                    doc["query"] = tok[-1]
-                
-        # if it wasn't in the 1st directory, check the 2nd
-        for name in filenames_2:
-            if lang == "en":
-                links_df = df_from_path(path_EN_IM_HO + "\\" + name)
-            else:
-                links_df = df_from_path(path_ES_IM_LA + "\\" + name)
-        
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_IM_HO.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_IM_LA.split("\\")
-                    doc["query"] = tok[-1]
+    return solr_data
+
+
+# Returns the "fl" parameter of Solr requests, SOLR_FIELDS plus 'extra_fields'
+# None means that every stored field is returned
+def solr_field_list(extra_fields=()):
+    if not solr_fields:
+        return None
+    
+    fields = ["id"]
+    for field in solr_fields + list(extra_fields):
+        if field not in fields:
+            fields.append(field)
+    
+    return ",".join(fields)
+
+
+# Query Solr Db using the query string input, and returns the JSON document
+def get_solr_data(query):
+    
+    solr_params = {
+        "indent":"true",
+        "q.op":"OR",
+        "q":query,
+        "rows": 7000,
+        "wt":"json"
+    }
+    
+    field_list = solr_field_list()
+    if field_list:
+        solr_params["fl"] = field_list
+    
+    # documents are handed to the scorer as they are decoded
+    if streaming_responses():
+        if solr_response_format == "csv" and field_list:
+            return solr_csv_documents(solr_params)
+        
+        return counted_documents(solr_doc_stream(solr_params))
+    
+    solr_data = solr_request(solr_params)
+    
+    documents = solr_data['response']['docs']
+    
+    return documents
+
+
+# Query Solr Db using the query string input, paging through all the results with a cursor
+# Yields the documents one by one, so only a single page of 'page_size' documents is kept in memory
+# 'extra_fields' are fetched on top of SOLR_FIELDS
+def stream_solr_data(query, page_size, extra_fields=()):
+    
+    # cursors need a sort on the unique key of the documents
+    solr_params = {
+        "q.op":"OR",
+        "q":query,
+        "rows": page_size,
+        "sort":"id asc",
+        "wt":"json"
+    }
+    
+    field_list = solr_field_list(extra_fields)
+    if field_list:
+        solr_params["fl"] = field_list
+    
+    return stream_solr_params(solr_params)
+
+
+# Pages through all the results of a request with a cursor, and yields the documents one by one
+# 'solr_params' must contain the page size ("rows") and a sort on the unique key ("id asc")
+def stream_solr_params(solr_params, post=False):
+    
+    cursor_mark = "*"
+    
+    while True:
+        solr_params["cursorMark"] = cursor_mark
+        
+        # the CSV response writer doesn't return the cursor, pages are always JSON
+        if streaming_responses():
+            stream = solr_doc_stream(solr_params, post)
+            
+            for doc in stream:
+                yield doc
+            
+            metrics.inc("solr_bytes_received_total", stream.bytes_received)
+            next_cursor_mark = stream.next_cursor_mark
+        else:
+            solr_data = solr_request(solr_params, post)
+            
+            for doc in solr_data['response']['docs']:
+                yield doc
+            
+            next_cursor_mark = solr_data['nextCursorMark']
+        
+        # Solr returns the same cursor again once there are no more results
+        if next_cursor_mark == cursor_mark:
+            break
+        
+        cursor_mark = next_cursor_mark
+
+
+# Returns the documents of a query, either as a single request or page by page (when SOLR_PAGE_SIZE is set)
+def get_solr_documents(query):
+    if solr_page_size > 0:
+        return stream_solr_data(query, solr_page_size)
+    
+    return get_solr_data(query)
+
+
+# Returns all the documents of a query as a list, used by the concurrent workers
+def get_all_solr_documents(query):
+    return list(get_solr_documents(query))
+
+
+# Fetches the documents of every query in 'queries', running up to 'workers' requests at the same time
+# Yields the documents of each query in the same order as 'queries', so scores and found keywords stay reproducible
+def fetch_solr_documents(queries, workers=None):
+    if workers is None:
+        workers = solr_workers
+    
+    # a single worker, just fetch the queries one after another
+    # when paging with a cursor, the pages of each query stream straight into the scorer
+    if workers <= 1:
+        for query in queries:
+            yield get_solr_documents(query)
+        return
+    
+    # each worker collects all the pages of its query, so memory is bounded by the requests in flight
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        
+        for query in queries:
+            pending.append(executor.submit(get_all_solr_documents, query))
+            
+            # keep at most 2 requests per worker in flight, so finished responses don't pile up in memory
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        
+        while pending:
+            yield pending.popleft().result()
+
+
+# Splits the indexes of 'queries' into consecutive batches, each one with at most 'max_clauses' clauses
+def batch_queries(queries, max_clauses):
+    batch = []
+    clauses = 0
+    
+    for index, query in enumerate(queries):
+        # keyword queries are made of text: " ... " clauses, joined with AND
+        query_clauses = query.count(" AND ") + 1
+        
+        if batch and clauses + query_clauses > max_clauses:
+            yield batch
+            batch = []
+            clauses = 0
+        
+        batch.append(index)
+        clauses = clauses + query_clauses
+    
+    if batch:
+        yield batch
+
+
+# Sends the queries of a batch as a single OR query, paging through the results with a cursor
+# every query also becomes a field of the response ("kw_<index>"), which is true when the document matches it
+# Yields each document together with the indexes of the queries that it matches, in the order of 'batch'
+def stream_topic_documents(queries, batch, page_size):
+    
+    fields = [solr_field_list() or "*"]
+    for index in batch:
+        fields.append("kw_" + str(index) + ":exists(query($kq_" + str(index) + "))")
+    
+    solr_params = {
+        "q.op":"OR",
+        "q":" OR ".join("(" + queries[index] + ")" for index in batch),
+        "fl":",".join(fields),
+        "rows": page_size,
+        "sort":"id asc",
+        "wt":"json"
+    }
+    
+    for index in batch:
+        solr_params["kq_" + str(index)] = queries[index]
+    
+    for doc in stream_solr_params(solr_params, post=True):
+        matched = []
+        
+        for index in batch:
+            if doc.pop("kw_" + str(index), False):
+                matched.append(index)
+        
+        yield doc, matched
+
+
+# Returns the batches of query indexes of 'queries', each one is sent as a single OR query
+def topic_query_batches(queries):
+    batches = list(batch_queries(queries, solr_max_clauses))
+    extended_logger.info("Sending " + str(len(queries)) + " keywords as " + str(len(batches)) + " OR queries")
+    
+    return batches
+
+
+# Yields, for each batch of 'batches', the documents that match any of its queries (see stream_topic_documents)
+def fetch_topic_batches(queries, batches):
+    page_size = solr_page_size if solr_page_size > 0 else 1000
+    
+    for batch in batches:
+        yield stream_topic_documents(queries, batch, page_size)
+
+
+# Fetches the documents that match any of the 'queries', with one request per batch of queries (and per page)
+# Yields each document together with the indexes of the queries that it matches
+def fetch_topic_documents(queries):
+    for documents in fetch_topic_batches(queries, topic_query_batches(queries)):
+        for doc, matched in documents:
+            yield doc, matched
+
+
+# matches a query made only of text: " ... " clauses joined with AND, as built by queryFromKeywordsList
+and_query_pattern = re.compile(r'\s*text:\s*"[^"]*"\s*(AND\s+text:\s*"[^"]*"\s*)*')
+
+
+# Returns the normalized form of a query: queries with the same normalized form return the same documents
+# the clauses of an AND query are sorted and repeated clauses are dropped, and whitespace is collapsed
+def normalized_query(query):
+    if and_query_pattern.fullmatch(query):
+        clauses = set(" ".join(clause.split()) for clause in re.findall(r'text:\s*"([^"]*)"', query))
+        return " AND ".join('text:"' + clause + '"' for clause in sorted(clauses))
+    
+    return " ".join(query.split())
+
+
+# Plan of the keyword queries of the run: how many times each normalized query is still needed
+# every query is sent to Solr once, and its documents are kept only until the last keyword that needs them is scored
+# with a 'spill_path', the documents that are kept are written to that file, and only their offsets are kept in memory
+class QueryPlan:
+    
+    def __init__(self, queries, spill_path=None):
+        self.remaining = {}
+        self.results = {}
+        self.spill = SpillFile(spill_path) if spill_path else None
+        
+        for query in queries:
+            key = normalized_query(query)
+            self.remaining[key] = self.remaining.get(key, 0) + 1
+        
+        self.total = len(queries)
+        self.unique = len(self.remaining)
+    
+    @property
+    def saved(self):
+        return self.total - self.unique
+    
+    # keeps the documents of a query for the keywords that need it later
+    def keep(self, key, documents):
+        if self.spill is None:
+            self.results[key] = [dict(doc) for doc in documents]
+        else:
+            self.results[key] = [self.spill.append(doc) for doc in documents]
+    
+    # returns a copy of the documents kept for a query
+    def kept(self, key):
+        if self.spill is None:
+            return [dict(doc) for doc in self.results[key]]
+        
+        # the file is appended to again after the documents are read back
+        self.spill.close()
+        self.spill.keep = True
+        
+        return list(SpilledDocuments(self.spill.path, self.results[key], None, {}))
+    
+    # removes the spill file, once every job of the plan is done
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            
+            if os.path.exists(self.spill.path):
+                os.remove(self.spill.path)
+    
+    # the keywords of 'queries' won't be scored in this run (a resumed job already did them)
+    def skip(self, queries):
+        for query in queries:
+            key = normalized_query(query)
+            self.remaining[key] = self.remaining[key] - 1
+            
+            if self.remaining[key] == 0:
+                self.results.pop(key, None)
+    
+    # Yields the documents of each query of 'queries', in order, sending to Solr only the queries that no
+    # keyword needed before. Documents of a query that is needed again are kept, and every later keyword
+    # gets its own copy of them, so topics never share (and update) the same document
+    def fetch(self, queries):
+        keys = [normalized_query(query) for query in queries]
+        
+        # queries that haven't been fetched yet, once each
+        pending = []
+        seen = set()
+        for query, key in zip(queries, keys):
+            if key not in self.results and key not in seen:
+                seen.add(key)
+                pending.append(query)
+        
+        fetched = fetch_solr_documents(pending)
+        
+        for key in keys:
+            self.remaining[key] = self.remaining[key] - 1
+            
+            if key in self.results:
+                documents = self.kept(key)
                 
-        # if it wasn't in the 2nd, it must be on the 3rd. Do a check just in case
-        for name in filenames_3:
-            if lang == "en":
-                links_df = df_from_path(path_EN_IM_IS + "\\" + name)
+                if self.remaining[key] == 0:
+                    del self.results[key]
+                
+                yield documents
+                continue
+            
+            documents = next(fetched)
+            
+            if self.remaining[key] > 0:
+                # kept aside before the scorer sees (and updates) the documents
+                documents = list(documents)
+                self.keep(key, documents)
+            
+            yield documents
+
+
+# Plan of the queries of the jobs of this process, None when keywords are fetched one by one
+query_plan = None
+
+
+# Plans the keyword queries of 'jobs' (a list of language and dict of topic -> keywords), and logs how many are saved
+def plan_queries(jobs):
+    global query_plan
+    
+    queries = []
+    for lang, topic_lists in jobs:
+        for topic, input_list in topic_lists.items():
+            queries.extend(TOPICS[topic]["query"](item) for item in input_list)
+    
+    # named after the process, the workers of a run each plan their own job
+    path = None
+    if spill_dir:
+        os.makedirs(spill_dir, exist_ok=True)
+        path = os.path.join(spill_dir, "query_plan_" + str(os.getpid()) + ".jsonl")
+    
+    query_plan = QueryPlan(queries, path)
+    metrics.inc("solr_queries_saved_total", query_plan.saved)
+    extended_logger.info("Query plan: " + str(query_plan.total) + " keyword queries, " + str(query_plan.unique)
+                         + " unique, " + str(query_plan.saved) + " saved")
+
+
+# Drops the query plan of the process, and the documents it still keeps
+def end_query_plan():
+    global query_plan
+    
+    if query_plan is not None:
+        query_plan.close()
+        query_plan = None
+
+
+# Returns the documents of each query of 'queries', in order (see fetch_solr_documents), through the query plan if there is one
+def fetch_keyword_documents(queries):
+    if query_plan is None:
+        return fetch_solr_documents(queries)
+    
+    return query_plan.fetch(queries)
+
+
+# -------------------- NEW FUNCTIONS START -------------------- #
+# Builds the query for a keyword line: stop words are removed, and the remaining words are joined with AND
+def cleanedQueryFromKeyword(item):
+    # split keywords on space key
+    tokens = item.split(" ")
+    
+    # remove de, de la, en, los, etc
+    clean = keywordsCleaner(tokens)
+    
+    return queryFromKeywordsList(clean)
+
+
+# Builds the query for a keyword line, searching the whole line as a phrase
+def phraseQueryFromKeyword(item):
+    return """text:" """ + item + """ " """
+
+
+# Settings for each topic, used by the scoring engine
+# "prefix" names the fields added to each document (<prefix>_score, <prefix>_found_keywords and <prefix>_query)
+# "query" turns a line of the keywords file into a Solr query string
+# "paths" holds the environment variables with the 3 directories of CSV files, per language, that are used to add the query field
+TOPICS = {
+    "climate": {
+        "prefix": "climate",
+        "label": "Climate",
+        "query": cleanedQueryFromKeyword,
+        "paths": {
+            "en": ["path_EN_CH_HOW", "path_EN_CH_IS", "path_EN_CH_WHAT"],
+            "es": ["path_ES_CH_AQ", "path_ES_CH_CO", "path_ES_CH_ES"],
+        },
+    },
+    "covid": {
+        "prefix": "covid",
+        "label": "Covid",
+        "query": cleanedQueryFromKeyword,
+        "paths": {
+            "en": ["path_EN_CV_SH", "path_EN_CV_WA", "path_EN_CV_WH"],
+            "es": ["path_ES_CV_DE", "path_ES_CV_FU", "path_ES_CV_QU"],
+        },
+    },
+    "immigration": {
+        "prefix": "immigration",
+        "label": "immigration",
+        "query": phraseQueryFromKeyword,
+        "paths": {
+            "en": ["path_EN_IM_AR", "path_EN_IM_HO", "path_EN_IM_IS"],
+            "es": ["path_ES_IM_CO", "path_ES_IM_LA", "path_ES_IM_RE"],
+        },
+    },
+}
+
+
+# Returns the CSV directories of a topic, for the given language ("en", anything else is Spanish)
+def topic_paths(topic, lang):
+    if lang == "en":
+        return [os.getenv(name) for name in TOPICS[topic]["paths"]["en"]]
+    return [os.getenv(name) for name in TOPICS[topic]["paths"]["es"]]
+
+
+# Tuples of field names shared by the compact records, each distinct tuple is stored only once
+record_schemas = {}
+
+
+# Returns the shared copy of a tuple of field names
+def intern_schema(keys):
+    keys = tuple(keys)
+    return record_schemas.setdefault(keys, keys)
+
+
+# Compact replacement of the dict of a scored document
+# field names live in a tuple shared by all records with the same fields, values in a plain list
+# it behaves like a dict, so it can be updated, checked and uploaded to MongoDB the same way
+class CompactDocument(MutableMapping):
+    
+    __slots__ = ("schema", "values")
+    
+    def __init__(self, doc):
+        self.schema = intern_schema(doc.keys())
+        self.values = list(doc.values())
+    
+    def __getitem__(self, key):
+        try:
+            return self.values[self.schema.index(key)]
+        except ValueError:
+            raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        if key in self.schema:
+            self.values[self.schema.index(key)] = value
+        else:
+            self.schema = intern_schema(self.schema + (key,))
+            self.values.append(value)
+    
+    def __delitem__(self, key):
+        try:
+            index = self.schema.index(key)
+        except ValueError:
+            raise KeyError(key)
+        
+        self.schema = intern_schema(self.schema[:index] + self.schema[index + 1:])
+        del self.values[index]
+    
+    def __iter__(self):
+        return iter(self.schema)
+    
+    def __len__(self):
+        return len(self.schema)
+    
+    def __contains__(self, key):
+        return key in self.schema
+
+
+# Weights of the keywords, read from KEYWORD_WEIGHTS the first time they are needed
+keyword_weights = None
+
+
+# Returns the dict of keyword weights, empty if KEYWORD_WEIGHTS is not set
+def get_keyword_weights():
+    global keyword_weights
+    
+    if keyword_weights is None:
+        keyword_weights = {}
+        
+        if keyword_weights_path:
+            with open(keyword_weights_path, "r", encoding='utf-8') as weights_file:
+                keyword_weights = json.load(weights_file)
+    
+    return keyword_weights
+
+
+# Keeps the scored documents of a topic, keyed by their "id"
+# hits are kept in a sparse document x keyword matrix, the scores and found keywords are only
+# written into the documents when the topic is finished (see to_list)
+# with a 'spill_path', the bodies of the documents are written to that file, and the matrix only keeps their offsets
+class ScoreAccumulator:
+    
+    def __init__(self, prefix, spill_path=None):
+        # imported here, so the commands that don't score never load NumPy
+        from incidence import IncidenceMatrix
+        
+        self.score_field = prefix + "_score"
+        self.keywords_field = prefix + "_found_keywords"
+        self.matrix = IncidenceMatrix()
+        self.saved = self.matrix.mark()
+        self.spill = SpillFile(spill_path) if spill_path else None
+    
+    def __len__(self):
+        return len(self.matrix)
+    
+    @property
+    def hits(self):
+        return self.matrix.hits
+    
+    # returns the row of the document 'doc', whose unique key is 'key_id'
+    def row(self, key_id, doc):
+        row = self.matrix.row_ids.get(key_id)
+        
+        # first time we see this document, it gets a row of the matrix
+        if row is None:
+            if self.spill is not None:
+                doc = self.spill.append(doc)
+            elif compact_records:
+                doc = CompactDocument(doc)
+            
+            row = self.matrix.add_row(key_id, doc)
+        
+        return row
+    
+    # registers that the keyword 'item' matched the document 'doc'
+    def add(self, doc, item):
+        # the unique key for each document is the field "id"
+        self.matrix.add(self.row(doc["id"], doc), self.matrix.add_column(item))
+    
+    # adds the hits of another accumulator, taken with its delta(), after the hits of this one
+    # documents and keywords the other accumulator shares with this one are matched by their key
+    def merge(self, partial):
+        keys, docs, columns, hit_rows, hit_columns = partial
+        
+        row_map = [self.row(key_id, doc) for key_id, doc in zip(keys, docs)]
+        column_map = [self.matrix.add_column(item) for item in columns]
+        
+        self.matrix.add_mapped(hit_rows, hit_columns, row_map, column_map)
+    
+    # returns the hits added since the previous call, to be saved in a checkpoint
+    def delta(self):
+        # the offsets in the checkpoint must point to bodies that are already on disk
+        if self.spill is not None:
+            self.spill.flush()
+        
+        delta = self.matrix.delta(self.saved)
+        self.saved = self.matrix.mark()
+        
+        return delta
+    
+    # adds the hits of the deltas saved in a checkpoint, in the order they were saved
+    def restore(self, deltas):
+        for delta in deltas:
+            self.matrix.apply(delta)
+        
+        self.saved = self.matrix.mark()
+        
+        # the spill file holds the bodies of the restored documents, new ones are added after them
+        if deltas and self.spill is not None:
+            self.spill.keep = True
+    
+    # returns the scored documents, as a list, in the order they were first found
+    # each one gets its score and the keywords it matched, in the order they were found
+    def to_list(self):
+        matrix = self.matrix
+        
+        weights = None
+        if get_keyword_weights():
+            weights = [keyword_weights.get(item, 1) for item in matrix.columns]
+        
+        scores = matrix.scores(weights)
+        selected = matrix.select(scores, score_threshold or None, score_top_n or None)
+        indptr, indices = matrix.to_csr()
+        
+        # plain Python numbers, MongoDB can't encode NumPy types
+        scores = scores.tolist()
+        indptr = indptr.tolist()
+        indices = indices.tolist()
+        
+        if self.spill is not None:
+            self.spill.close()
+            
+            selected = selected.tolist()
+            ids = list(matrix.row_ids)
+            found_keywords = [[matrix.columns[column] for column in indices[indptr[row]:indptr[row + 1]]] for row in selected]
+            
+            return SpilledDocuments(self.spill.path, [matrix.rows[row] for row in selected], [ids[row] for row in selected],
+                                    {self.score_field: [scores[row] for row in selected], self.keywords_field: found_keywords})
+        
+        documents_list = []
+        for row in selected.tolist():
+            doc = matrix.rows[row]
+            doc[self.score_field] = scores[row]
+            doc[self.keywords_field] = [matrix.columns[column] for column in indices[indptr[row]:indptr[row + 1]]]
+            documents_list.append(doc)
+        
+        return documents_list
+
+
+# Checkpoint of the run, opened the first time it is needed
+checkpoint = None
+
+
+# Returns the checkpoint of the run, or None when CHECKPOINT_EVERY is 0
+def get_checkpoint():
+    global checkpoint
+    
+    if checkpoint_every <= 0:
+        return None
+    
+    if checkpoint is None:
+        checkpoint = Checkpoint(checkpoint_path)
+    
+    return checkpoint
+
+
+# Returns the name of a job: its topics, its language, and a hash of everything that changes its hits
+def job_name(lang, topic_lists):
+    settings = json.dumps([scoring_mode, solr_max_clauses, solr_fields, topic_lists], sort_keys=True)
+    
+    return ",".join(topic_lists) + ":" + lang + ":" + hashlib.sha1(settings.encode("utf-8")).hexdigest()
+
+
+# Returns the spill file of a topic of a job, or None when documents are kept in memory
+# a resumed job finds the bodies of the documents it had already scored in the same file
+def spill_path(lang, topic_lists, topic):
+    if not spill_dir:
+        return None
+    
+    os.makedirs(spill_dir, exist_ok=True)
+    name = hashlib.sha1(job_name(lang, topic_lists).encode("utf-8")).hexdigest()[:16]
+    
+    return os.path.join(spill_dir, name + "_" + topic + "_" + lang + ".jsonl")
+
+
+# Removes the spill files of the scored documents of a language (a dict of topic -> documents), once they are uploaded
+def remove_spilled(topic_articles):
+    for documents_list in topic_articles.values():
+        if isinstance(documents_list, SpilledDocuments):
+            documents_list.remove()
+
+
+# Progress of a scoring job, saved to the checkpoint of the run
+# the job is named after its topics, its language, and everything that changes its hits (the keywords,
+# the scoring mode, ...), so a resumed run never picks up the progress of a job that would score differently
+# with 'saved' False nothing is saved nor restored (the work items of sharded scoring are retried whole)
+class JobProgress:
+    
+    def __init__(self, lang, topic_lists, accumulators, saved=True):
+        self.accumulators = accumulators
+        self.store = get_checkpoint() if saved else None
+        self.position = 0
+        self.finished = False
+        self.unsaved = 0
+        
+        self.job = job_name(lang, topic_lists)
+        
+        if self.store is not None:
+            self.position, self.finished, deltas = self.store.load(self.job)
+            
+            for topic, accumulator in accumulators.items():
+                accumulator.restore([delta[topic] for delta in deltas])
+            
+            if self.position or self.finished:
+                extended_logger.info("Resuming " + self.job + " after " + str(self.position) + " units"
+                                     + (" (finished)" if self.finished else ""))
+    
+    # registers that one more unit (a keyword, or a batch of keywords) is done
+    # progress is saved once 'every' units are done since the last save
+    def advance(self, every=None):
+        self.position = self.position + 1
+        self.unsaved = self.unsaved + 1
+        
+        if every is None:
+            every = checkpoint_every
+        
+        if self.unsaved >= every:
+            self.save()
+    
+    # saves the position and the hits found since the last save
+    def save(self, finished=False):
+        if self.store is None:
+            return
+        
+        delta = {topic: accumulator.delta() for topic, accumulator in self.accumulators.items()}
+        self.store.save(self.job, self.position, delta, finished)
+        self.unsaved = 0
+    
+    # saves that the job is finished, a resumed run only has to add the query field to its documents
+    def finish(self):
+        self.finished = True
+        self.save(finished=True)
+
+
+# Link indexes that have been built in this run, keyed by their tuple of directories
+# this way each CSV file is parsed only once per run, no matter how many documents are scored
+link_indexes = {}
+
+
+# Reads all CSV files in the 'paths' directories, and returns a dict that maps each link to its query
+# the name of each directory is essentially the query that was done for that dataset
+# directories are read in order, so if a link exists in more than one, the last one wins
+def build_link_index(paths):
+    link_index = {}
+    
+    for path in paths:
+        # the query is the name of the directory, on Windows and POSIX paths alike
+        query = os.path.basename(os.path.normpath(path))
+        
+        for name in find_csv_filenames(path):
+            links_df = df_from_path(os.path.join(path, name))
+            
+            for link in links_df['link'].dropna():
+                link_index[link] = query
+    
+    return link_index
+
+
+# Returns the on-disk link index of the 'paths' directories, compiling the CSV files that changed since the last run
+def open_link_index(paths):
+    # imported here, NumPy is only needed by the on-disk index
+    from link_index import LinkIndexStore
+    
+    return LinkIndexStore(link_index_dir).open(paths, find_csv_filenames)
+
+
+# Returns the link index of the 'paths' directories, building it the first time it is needed
+# both kinds of index have the get() of a dict
+def get_link_index(paths):
+    key = tuple(paths)
+    
+    if key not in link_indexes:
+        with metrics.stage("link_index"):
+            if link_index_mode == "disk":
+                link_indexes[key] = open_link_index(paths)
             else:
-                links_df = df_from_path(path_ES_IM_RE + "\\" + name)
+                link_indexes[key] = build_link_index(paths)
+        
+        metrics.inc("stage_items_total", len(link_indexes[key]), stage="link_index")
+    
+    return link_indexes[key]
+
+
+# Adds the query field of a topic (<prefix>_query) to each document, by looking up its link in the index of the 'paths' directories
+# each topic attributes the article to one of its own CSV directories, so the query is stored per topic, next to the score
+# and found keywords: an article found by several topics keeps the query of each one, in every upload mode and output file
+def add_query_field(documents_list, paths, prefix):
+    link_index = get_link_index(paths)
+    field = prefix + "_query"
+    
+    # spilled documents keep the query with their scores, the bodies on disk are never rewritten
+    if isinstance(documents_list, SpilledDocuments):
+        documents_list.set_field(field, [link_index.get(key_id) for key_id in documents_list.ids])
+        return
+    
+    # each item in the documents_list has a key labelled "id", which is a web link
+    # this web link is unique, so a single lookup tells us in which directory it exists
+    for doc in documents_list:
+        query = link_index.get(doc["id"])
         
-            check = (links_df['link'].eq(doc_link)).any()
-            if(check):
-                if lang == "en":
-                    tok = path_EN_IM_IS.split("\\")
-                    doc["query"] = tok[-1]
-                else:
-                    tok = path_ES_IM_RE.split("\\")
-                    doc["query"] = tok[-1]
+        if query is not None:
+            doc[field] = query
+
+
+# Scoring engine, shared by all topics
+# Receives the topic name (a key of TOPICS), a list containing its keywords, and the language ("en" or "es")
+# Returns a list of articles, scored for the topic keywords
+def topicScoring(topic, input_list, lang):
+    
+    config = TOPICS[topic]
+    accumulator = ScoreAccumulator(config["prefix"], spill_path(lang, {topic: input_list}, topic))
+    
+    # a resumed run starts with the hits of the keywords that were already done
+    progress = JobProgress(lang, {topic: input_list}, {topic: accumulator})
+    
+    score_keywords(topic, input_list, accumulator, progress)
     
+    return finishTopicScoring(topic, accumulator, lang)
+
+
+# Fetches the documents of the keywords of a topic, and adds their hits to 'accumulator'
+# 'progress' is the JobProgress of the keywords: scoring starts after the keywords it says are done
+def score_keywords(topic, input_list, accumulator, progress):
+    
+    config = TOPICS[topic]
+    queries = [config["query"](item) for item in input_list]
+    
+    # fetching and scoring are interleaved, the time waiting for Solr is in the solr_request_seconds histogram
+    with metrics.stage("score"):
+        if progress.finished:
+            if query_plan is not None and scoring_mode != "topic":
+                query_plan.skip(queries)
+        elif scoring_mode == "topic":
+            # one OR query per batch of keywords, each document tells which keywords it matched
+            # batches are those of the whole keyword list, so the found keywords keep their order across batches
+            # within a batch every distinct query is sent once, and the keywords that share it all get its documents
+            batches = []
+            items = {}
+            
+            for batch in topic_query_batches(queries):
+                first_index = {}
+                unique_batch = []
+                
+                for index in batch:
+                    key = normalized_query(queries[index])
+                    
+                    if key not in first_index:
+                        first_index[key] = index
+                        items[index] = []
+                        unique_batch.append(index)
+                    
+                    items[first_index[key]].append(index)
+                
+                batches.append(unique_batch)
+            
+            saved = len(queries) - sum(len(batch) for batch in batches)
+            
+            metrics.inc("solr_queries_saved_total", saved)
+            extended_logger.info("Query plan: " + str(len(queries)) + " " + topic + " keyword queries, "
+                                 + str(len(queries) - saved) + " unique, " + str(saved) + " saved")
+            
+            for documents in fetch_topic_batches(queries, batches[progress.position:]):
+                for doc, matched in documents:
+                    for index in sorted(index for unique_index in matched for index in items[unique_index]):
+                        accumulator.add(doc, input_list[index])
                 
-    num = docChecker(documents_list)
+                progress.advance(every=1)
+        else:
+            # responses come back in keyword order, even when they are fetched concurrently
+            start = progress.position
+            
+            if query_plan is not None:
+                query_plan.skip(queries[:start])
+            
+            for item, documents in zip(input_list[start:], fetch_keyword_documents(queries[start:])):
+                for doc in documents:
+                    accumulator.add(doc, item)
+                
+                progress.advance()
+        
+        progress.finish()
+    
+    metrics.inc("stage_items_total", accumulator.hits, stage="score")
+
+
+# Receives the topic name, the ScoreAccumulator with its scored documents, and the language ("en" or "es")
+# Adds the query field to the scored documents, and returns them as a list
+def finishTopicScoring(topic, accumulator, lang):
+    
+    config = TOPICS[topic]
+    documents_list = accumulator.to_list()
+    
+    extended_logger.info("Number of " + config["label"] + " scored articles " + str(len(documents_list)))
+    # scoring is finished, now let's add the query string to the body of each json item
+    with metrics.stage("attribution"):
+        add_query_field(documents_list, topic_paths(topic, lang), config["prefix"])
+    
+    metrics.inc("stage_items_total", len(documents_list), stage="attribution")
+    metrics.inc("documents_scored_total", len(documents_list), topic=topic, lang=lang)
+    
+    num = docChecker(documents_list, config["prefix"])
     extended_logger.info("Number of documents with query field: " + str(num))
     
     # documents list is fully updated now
     return documents_list
 
 
+# matches the text: " ... " clauses of a keyword query
+clause_pattern = re.compile(r'text:\s*"([^"]*)"')
+
+
+# Returns the clauses of a keyword query, each one as a tuple of tokens
+# clauses are joined with AND, so all of them must appear in an article for the query to match it
+def clausesFromQuery(query):
+    clauses = []
+    
+    for clause in clause_pattern.findall(query):
+        tokens = tokenize(clause)
+        
+        # clauses without any words (e.g. "&") are ignored by Solr too
+        if tokens:
+            clauses.append(tuple(tokens))
+    
+    return clauses
+
+
+# Builds a single automaton for the keywords of several topics. 'topic_lists' maps a topic name to its keywords
+# Returns the automaton, the list of keywords as (topic, item, set of clause ids),
+# and a dict that maps each clause id to the indexes of the keywords that contain it
+def build_keyword_automaton(topic_lists):
+    automaton = PhraseAutomaton()
+    clause_ids = {}
+    keywords = []
+    clause_keywords = {}
+    
+    for topic, input_list in topic_lists.items():
+        query_builder = TOPICS[topic]["query"]
+        
+        for item in input_list:
+            # same stop words and the same AND of terms as the Solr queries
+            clauses = set()
+            
+            for clause in clausesFromQuery(query_builder(item)):
+                if clause not in clause_ids:
+                    clause_ids[clause] = len(clause_ids)
+                    automaton.add(clause, clause_ids[clause])
+                
+                clauses.add(clause_ids[clause])
+                clause_keywords.setdefault(clause_ids[clause], []).append(len(keywords))
+            
+            keywords.append((topic, item, clauses))
+    
+    automaton.build()
+    
+    return automaton, keywords, clause_keywords
+
+
+# Returns the indexes of the keywords that match a document, in keyword order
+def match_keywords(doc, automaton, keywords, clause_keywords):
+    text = doc.get("text", "")
+    
+    # multivalued fields, phrases can't span two values
+    if not isinstance(text, list):
+        text = [text]
+    
+    found = set()
+    for value in text:
+        found.update(automaton.search(tokenize(str(value))))
+    
+    # only keywords that contain at least one of the found clauses can match
+    candidates = set()
+    for clause_id in found:
+        candidates.update(clause_keywords[clause_id])
+    
+    return sorted(index for index in candidates if keywords[index][2] <= found)
+
+
+# Scores the articles of a language for all topics, with a single pass over its corpus
+# Receives the 3 keyword lists, and the language ("en" or "es")
+# Returns 3 separate lists of scored articles, same as eng_score_routine and es_score_routine
+def local_score_routine(climate_input_list, covid_input_list, immigration_input_list, lang):
+    
+    topic_lists = {
+        "climate": climate_input_list,
+        "covid": covid_input_list,
+        "immigration": immigration_input_list,
+    }
+    
+    articles = local_score_topics(topic_lists, lang)
+    
+    return articles["climate"], articles["covid"], articles["immigration"]
+
+
+# Scores the articles of a language for the topics of 'topic_lists' (a dict of topic -> keywords), with a single pass over its corpus
+# Returns a dict that maps each topic to its scored articles
+def local_score_topics(topic_lists, lang):
+    
+    automaton, keywords, clause_keywords = build_keyword_automaton(topic_lists)
+    accumulators = {topic: ScoreAccumulator(TOPICS[topic]["prefix"], spill_path(lang, topic_lists, topic)) for topic in topic_lists}
+    
+    # the corpus is a single pass, progress is only saved once it is finished
+    progress = JobProgress(lang, topic_lists, accumulators)
+    
+    if lang == "en":
+        corpus_query = corpus_query_en
+    else:
+        corpus_query = corpus_query_es
+    
+    page_size = solr_page_size if solr_page_size > 0 else 1000
+    
+    with metrics.stage("score"):
+        if not progress.finished:
+            score_corpus(stream_solr_data(corpus_query, page_size, ("text",)),
+                         automaton, keywords, clause_keywords, accumulators)
+            progress.finish()
+    
+    metrics.inc("stage_items_total", sum(accumulator.hits for accumulator in accumulators.values()), stage="score")
+    
+    return {topic: finishTopicScoring(topic, accumulators[topic], lang) for topic in topic_lists}
+
+
+# Matches every document of 'corpus' against the keywords of the automaton, and adds the hits to the topic accumulators
+def score_corpus(corpus, automaton, keywords, clause_keywords, accumulators):
+    
+    # the text is needed for matching, even when SOLR_FIELDS doesn't keep it
+    drop_text = bool(solr_fields) and "text" not in solr_fields
+    
+    for doc in corpus:
+        matched = match_keywords(doc, automaton, keywords, clause_keywords)
+        
+        if drop_text:
+            doc.pop("text", None)
+        
+        # each topic gets its own copy of the document, topic lists are uploaded separately
+        topic_docs = {}
+        
+        for index in matched:
+            topic, item, clauses = keywords[index]
+            
+            if topic not in topic_docs:
+                topic_docs[topic] = dict(doc)
+            
+            accumulators[topic].add(topic_docs[topic], item)
+
+
+# Returns the watermark saved by the last successful incremental run, or None if there isn't any
+def load_watermark():
+    if not os.path.exists(watermark_path):
+        return None
+    
+    with open(watermark_path, "r", encoding='utf-8') as watermark_file:
+        return json.load(watermark_file).get("watermark")
+
+
+# Saves the watermark of a successful incremental run
+# the file is replaced in a single step, so a crash never leaves a half written watermark
+def save_watermark(watermark):
+    temp_path = watermark_path + ".tmp"
+    
+    with open(temp_path, "w", encoding='utf-8') as watermark_file:
+        json.dump({"watermark": watermark}, watermark_file)
+    
+    os.replace(temp_path, watermark_path)
+
+
+# Returns the newest value of SOLR_TIMESTAMP_FIELD in the index, or None if the index is empty
+def newest_timestamp():
+    solr_params = {
+        "q":"*:*",
+        "fl":solr_timestamp_field,
+        "rows": 1,
+        "sort":solr_timestamp_field + " desc",
+        "wt":"json"
+    }
+    
+    documents = solr_request(solr_params)['response']['docs']
+    
+    if not documents:
+        return None
+    
+    return documents[0][solr_timestamp_field]
+
+
+# Starts an incremental run: every Solr request from now on only asks for the documents indexed
+# after the saved watermark, and up to the newest document of the index right now
+# documents indexed while the run is going are left for the next run
+# Returns the new watermark, to be saved with save_watermark() once the run has finished
+def begin_delta_run():
+    global delta_filter
+    
+    watermark = load_watermark()
+    new_watermark = newest_timestamp()
+    
+    if new_watermark is None:
+        extended_logger.info("Solr index is empty, nothing to score")
+        delta_filter = "-*:*"
+        return watermark
+    
+    if watermark is None:
+        extended_logger.info("No watermark found, scoring every document up to " + str(new_watermark))
+        delta_filter = solr_timestamp_field + ":[* TO " + str(new_watermark) + "]"
+    else:
+        extended_logger.info("Scoring documents indexed after " + str(watermark) + ", up to " + str(new_watermark))
+        delta_filter = solr_timestamp_field + ":{" + str(watermark) + " TO " + str(new_watermark) + "]"
+    
+    return new_watermark
+
+
+# Returns the ids of all the documents of the incremental run
+def delta_document_ids():
+    page_size = solr_page_size if solr_page_size > 0 else 1000
+    
+    solr_params = {
+        "q":"*:*",
+        "fl":"id",
+        "rows": page_size,
+        "sort":"id asc",
+        "wt":"json"
+    }
+    
+    return set(doc["id"] for doc in stream_solr_params(solr_params))
+
+
+# Documents of an incremental run may have been scored before, and no longer match some topic
+# Receives the language, a dict that maps each topic to its scored documents, and the ids of the run
+# Removes the old score and found keywords of every topic that the documents don't match anymore
+def clear_stale_scores(lang, topic_articles, delta_ids):
+    collection = get_collection(lang)
+    
+    for topic, documents_list in topic_articles.items():
+        prefix = TOPICS[topic]["prefix"]
+        if isinstance(documents_list, SpilledDocuments):
+            scored = set(documents_list.ids)
+        else:
+            scored = set(doc["id"] for doc in documents_list)
+        stale = [key_id for key_id in delta_ids if key_id not in scored]
+        
+        for batch in iter_batches(stale, mongo_batch_size):
+            collection.update_many({"id": {"$in": batch}},
+                                   {"$unset": {prefix + "_score": "", prefix + "_found_keywords": "", prefix + "_query": "",
+                                               prefix + "_fingerprint": ""}})
+
+
+# Receives a list containg climate keywords
+# Also receives language ("en" or "es")
+# Returns a list of articles, scored for climate keywords
+def climateScoringV2(climate_input_list, lang):
+    return topicScoring("climate", climate_input_list, lang)
+
+
+# Receives a list containg covid keywords
+# Also receives language ("en" or "es")
+# Returns a list of articles, scored for covid keywords
+def covidScoringV2(covid_input_list, lang):
+    return topicScoring("covid", covid_input_list, lang)
+
+
+# Receives a list containg immigration keywords
+# Also receives language ("en" or "es")
+# Returns a list of articles, scored for immigration keywords
+def immigrationScoringV2(immigration_input_list, lang):
+    return topicScoring("immigration", immigration_input_list, lang)
+
+
+    
+# Runs in every new worker process: HTTP sessions and SQLite connections can't be shared with the parent process,
+# so each worker creates its own the first time it needs them
+# the filter of an incremental run is passed along, workers that start a fresh interpreter don't inherit it
+def init_worker(filter_query):
+    global solr_session, solr_limiter, solr_breaker, solr_cache, checkpoint, delta_filter, mongo_client, collection_en, collection_es
+    
+    solr_session = None
+    solr_limiter, solr_breaker = create_solr_throttle()
+    solr_cache = None
+    checkpoint = None
+    delta_filter = filter_query
+    
+    # workers never upload, but they must not reuse the connections of the parent either
+    mongo_client = None
+    collection_en = None
+    collection_es = None
+    
+    # forked workers start with a copy of the parent metrics, they only report their own
+    metrics.reset()
+
+
+# Scores a job: a topic of a language, or all the topics of a language in "local" scoring mode
+# Receives the language and a dict that maps each topic of the job to its keywords
+# Returns the language, a dict that maps each topic to its scored documents, and the time the job took
+def score_job(lang, topic_lists):
+    start = time.perf_counter()
+    
+    if scoring_mode == "local":
+        # the "score" command may ask for only some of the topics
+        results = local_score_topics(topic_lists, lang)
+    else:
+        results = {}
+        for topic, input_list in topic_lists.items():
+            results[topic] = topicScoring(topic, input_list, lang)
+    
+    return lang, results, time.perf_counter() - start
+
+
+# Runs score_job in a worker process, and also returns the metrics of the job, to be merged in the parent process
+# each worker only shares the results of the queries within its own job
+def score_job_in_worker(lang, topic_lists):
+    metrics.reset()
+    
+    if scoring_mode == "keyword" and query_planning:
+        plan_queries([(lang, topic_lists)])
+    
+    try:
+        lang, results, elapsed = score_job(lang, topic_lists)
+    finally:
+        end_query_plan()
+    
+    return lang, results, elapsed, metrics.snapshot()
+
+
+# Scores every topic of every language in 'languages', running up to 'workers' jobs at the same time in separate processes
+# 'keyword_lists' maps each language to a dict of topic -> keywords
+# if an uploader is given (a BackgroundUploader or an ExportSink), the results of each job are handed to it as soon as the job finishes
+# Returns a dict that maps each language to a dict of topic -> scored documents
+def run_scoring_jobs(keyword_lists, languages, workers=None, uploader=None):
+    if workers is None:
+        workers = scoring_workers
+    
+    # in "local" mode a single pass scores every topic, so there is one job per language
+    jobs = []
+    for lang in languages:
+        if scoring_mode == "local":
+            jobs.append((lang, keyword_lists[lang]))
+        else:
+            for topic, input_list in keyword_lists[lang].items():
+                jobs.append((lang, {topic: input_list}))
+    
+    # topics keep the order of 'keyword_lists', whatever order the jobs finish in
+    results = {lang: dict.fromkeys(keyword_lists[lang]) for lang in languages}
+    
+    def collect(lang, job_results, elapsed):
+        extended_logger.info("Scored " + ", ".join(job_results) + " (" + lang + ") in " + format(elapsed, ".1f") + "s")
+        
+        for topic, documents_list in job_results.items():
+            results[lang][topic] = documents_list
+            
+            if uploader is not None:
+                uploader.upload(documents_list, lang, topic)
+    
+    if workers <= 1:
+        # every query of the run is sent once, its documents are shared by all the keywords, topics and languages that need it
+        if scoring_mode == "keyword" and query_planning:
+            plan_queries(jobs)
+        
+        try:
+            for lang, topic_lists in jobs:
+                collect(*score_job(lang, topic_lists))
+        finally:
+            end_query_plan()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(delta_filter,)) as executor:
+            futures = [executor.submit(score_job_in_worker, lang, topic_lists) for lang, topic_lists in jobs]
+            
+            for future in as_completed(futures):
+                lang, job_results, elapsed, job_metrics = future.result()
+                metrics.merge(job_metrics)
+                collect(lang, job_results, elapsed)
     
+    return results
+
+
 # -------------------- NEW FUNCTIONS END -------------------- #
 
 # ******************************************************************************************************** 
 
 # ******************************************************************************************************** 
 
-def main():
-    # create lists from txt files first
-    List_climate_english = make_list_from_file(file_climate_english)
+# Writes the time and throughput of every stage of the run to the log
+def log_stage_summary():
+    for stage, values in metrics.summary()["stages"].items():
+        extended_logger.info("Stage " + stage + ": " + str(values["runs"]) + " runs, " + format(values["seconds"], ".1f") + "s, "
+                             + str(values["items"]) + " items (" + format(values["items_per_sec"], ".0f") + "/s)")
+
+
+# Returns the keywords of every topic of the given languages, as a dict of language -> {topic: keywords}
+def load_keyword_lists(languages, topics=("climate", "covid", "immigration")):
+    return {lang: {topic: load_keywords(lang, topic) for topic in topics} for lang in languages}
+
+
+# Removes the duplicated articles from MongoDB
+def merge_duplicates():
+    # imported here, so the stages that don't merge never load it
+    from merge_duplicates import merger
     
-    List_climate_spanish = make_list_from_file(file_climate_spanish)
+    with metrics.stage("merge"):
+        merger()
+
+
+# Starts the checkpoint of a run: a resumed run keeps the progress that was saved, any other run starts from scratch
+def start_checkpoint(resume):
+    store = get_checkpoint()
     
-    List_covid_english = make_list_from_file(file_covid_english)
+    if store is not None and not resume:
+        store.clear()
+
+
+# Starts an incremental run, or picks up the interrupted one when resuming, so the resumed run scores the same documents
+# Returns the watermark of the last successful run, and the new one
+def start_delta_run(resume):
+    global delta_filter
+    
+    store = get_checkpoint()
+    
+    if resume and store is not None:
+        delta_run = store.get_meta("delta_run")
+        
+        if delta_run is not None:
+            delta_filter = delta_run["filter"]
+            return delta_run["watermark"], delta_run["new_watermark"]
+    
+    watermark = load_watermark()
+    new_watermark = begin_delta_run()
+    
+    if store is not None:
+        store.set_meta("delta_run", {"filter": delta_filter, "watermark": watermark, "new_watermark": new_watermark})
+    
+    return watermark, new_watermark
+
+
+# The run has finished, its progress is not needed anymore
+def finish_checkpoint():
+    store = get_checkpoint()
     
-    List_covid_spanish = make_list_from_file(file_covid_spanish)
+    if store is not None:
+        store.clear()
+
+
+def main(languages=None, resume=False):
+    if languages is None:
+        languages = score_languages
     
-    List_immigration_english = make_list_from_file(file_immigration_english)
+    start_checkpoint(resume)
     
-    List_immigration_spanish = make_list_from_file(file_immigration_spanish)
+    # create lists from txt files first
+    keyword_lists = load_keyword_lists(languages)
     
-    # get English articles with their scores. This is a list of JSON documents
-    '''EN_climate_scored, EN_covid_score, EN_immigration_scored = eng_score_routine(List_climate_english, 
-                                                                                 List_covid_english, 
-                                                                                 List_immigration_english)'''
+    # incremental runs only score the documents indexed since the last run
+    if incremental:
+        watermark, new_watermark = start_delta_run(resume)
     
-    # get Spanish articles with their scores. This is a list of JSON documents
-    ES_climate_scored, ES_covid_score, ES_immigration_scored = es_score_routine(List_climate_spanish, 
-                                                                                List_covid_spanish, 
-                                                                                List_immigration_spanish)
+    # with a background writer or an export sink, each job is written while the next ones are being scored
+    uploader = create_uploader()
     
-    # upload English articles to MongoDB
-    '''extended_logger.info("uploading documents...")
-    upload_documents(EN_climate_scored, "en")
-    upload_documents(EN_covid_score, "en")
-    upload_documents(EN_immigration_scored, "en")'''
+    # get the articles of every language with their scores. These are lists of JSON documents
+    results = run_scoring_jobs(keyword_lists, languages, scoring_workers, uploader)
     
-    extended_logger.info("uploaded English articles")
+    publish_results(results, languages, uploader, (watermark, new_watermark) if incremental else None)
     
-    # upload Spanish articles to MongoDB
-    upload_documents(ES_climate_scored, "es")
-    upload_documents(ES_covid_score, "es")
-    upload_documents(ES_immigration_scored, "es")
+    finish_checkpoint()
     
-    extended_logger.info("uploaded Spanish articles")
+    log_stage_summary()
+    metrics.export(metrics_json_path, metrics_prometheus_path)
+
+
+# Returns the writer that scored articles are handed to as each job finishes: an ExportSink, a BackgroundUploader,
+# or None to upload them all once scoring is done
+def create_uploader():
+    if output_sink == "export":
+        return ExportSink(export_dir, export_format, export_chunk_rows)
+    
+    if mongo_background_upload:
+        return BackgroundUploader()
+    
+    return None
+
+
+# Uploads (or exports) the scored articles of a run, and cleans up after it
+# 'results' maps each language to a dict of topic -> scored documents, 'uploader' is the one from create_uploader()
+# 'watermarks' is the (watermark, new watermark) pair of an incremental run, or None
+def publish_results(results, languages, uploader, watermarks=None):
+    if uploader is not None:
+        uploader.close()
+    else:
+        # upload articles to MongoDB
+        extended_logger.info("uploading documents...")
+        for lang in languages:
+            for topic in ["climate", "covid", "immigration"]:
+                upload_documents(results[lang][topic], lang)
+    
+    if output_sink == "export":
+        extended_logger.info("exported articles to " + export_dir)
+    else:
+        for lang in languages:
+            if lang == "en":
+                extended_logger.info("uploaded English articles")
+            else:
+                extended_logger.info("uploaded Spanish articles")
+        
+        upload_stats.log_summary()
+        
+        # failed batches (the background writer only logs them) would be lost for good once the watermark moves
+        if upload_stats.failed:
+            raise UploadFailedError(str(upload_stats.failed) + " documents failed to upload, the run is not complete")
+    
+    # the scores of the run are in MongoDB, remove the ones that are no longer valid and move the watermark
+    # exported scores are loaded later, old scores of documents that no longer match aren't removed then
+    if watermarks is not None:
+        watermark, new_watermark = watermarks
+        
+        if watermark is not None and output_sink != "export":
+            delta_ids = delta_document_ids()
+            for lang in languages:
+                clear_stale_scores(lang, results[lang], delta_ids)
+        
+        save_watermark(new_watermark)
+    
+    if solr_cache is not None:
+        extended_logger.info("Solr cache: " + str(solr_cache.hits) + " hits, " + str(solr_cache.misses) + " misses")
     
     # after the uploading process, clean MongoDB from duplicates. Yes, there will be duplicates!
-    merger()
+    # upserts (and diff uploads) already keep a single document per article, there is nothing to merge
+    if mongo_upload_mode == "insert" and output_sink != "export":
+        merge_duplicates()
+    
+    for lang in languages:
+        remove_spilled(results[lang])
+
+
+# Scores the given topics of the given languages, without uploading them
+# the scored articles of each topic are written to '<output_dir>/<topic>_<lang>.jsonl', one JSON document per line
+def score_command(languages, topics, output_dir, resume=False):
+    os.makedirs(output_dir, exist_ok=True)
+    
+    start_checkpoint(resume)
+    
+    results = run_scoring_jobs(load_keyword_lists(languages, topics), languages)
+    
+    for lang in languages:
+        for topic in topics:
+            path = os.path.join(output_dir, topic + "_" + lang + ".jsonl")
+            
+            with open(path, "w", encoding='utf-8') as output_file:
+                for document in results[lang][topic]:
+                    output_file.write(json.dumps(dict(document), ensure_ascii=False, default=str) + "\n")
+            
+            extended_logger.info("Wrote " + str(len(results[lang][topic])) + " articles to " + path)
+        
+        remove_spilled(results[lang])
+    
+    finish_checkpoint()
+    
+    log_stage_summary()
+    metrics.export(metrics_json_path, metrics_prometheus_path)
+
+
+# Loads the chunks of an export directory into MongoDB, up to 'workers' chunks at the same time
+# only the chunks of the given languages and topics are loaded. Duplicates are merged afterwards, same as a run
+def import_command(directory, languages, topics, workers):
+    manifest = read_manifest(directory)
+    entries = [entry for entry in manifest["files"] if entry["lang"] in languages and entry["topic"] in topics]
+    
+    extended_logger.info("Importing " + str(len(entries)) + " chunks (" + str(sum(entry["rows"] for entry in entries))
+                         + " articles) from " + directory)
+    
+    # exports written before the query was stored per topic are loaded in the current schema
+    def import_chunk(entry):
+        upload_documents(map(migrate_query_field, read_chunk(directory, entry, manifest["format"])), entry["lang"])
+    
+    # the MongoDB client is thread safe, every worker uses its pool
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for future in [executor.submit(import_chunk, entry) for entry in entries]:
+            future.result()
+    
+    upload_stats.log_summary()
+    
+    if mongo_upload_mode == "insert":
+        merge_duplicates()
+    
+    log_stage_summary()
+    metrics.export(metrics_json_path, metrics_prometheus_path)
+
+
+# Sharded scoring, step 1: splits the keywords of every topic of the given languages into work items of up to
+# 'item_keywords' keywords, in the queue at 'path'. Workers score the items (work_command), then the reducer
+# merges them into the scored articles (reduce_command)
+def coordinate_command(languages, path, item_keywords):
+    # "local" mode scores the whole corpus in one pass, there are no keyword queries to split
+    if scoring_mode == "local":
+        extended_logger.error("Sharded scoring splits the keyword queries, it can't be used in \"local\" scoring mode")
+        return
+    
+    item_keywords = max(item_keywords, 1)
+    keyword_lists = load_keyword_lists(languages)
+    
+    # the workers and the reducer of an incremental run all use the filter and watermarks chosen here
+    delta_run = None
+    if incremental:
+        watermark = load_watermark()
+        new_watermark = begin_delta_run()
+        delta_run = {"filter": delta_filter, "watermark": watermark, "new_watermark": new_watermark}
+    
+    items = []
+    for lang in languages:
+        for topic, input_list in keyword_lists[lang].items():
+            for start in range(0, len(input_list), item_keywords):
+                items.append((lang, topic, start, input_list[start:start + item_keywords]))
+    
+    work_queue = WorkQueue(path, work_lease)
+    work_queue.create(items, {"languages": languages, "scoring_mode": scoring_mode, "delta_run": delta_run})
+    work_queue.close()
+    
+    extended_logger.info("Queued " + str(len(items)) + " work items of up to " + str(item_keywords) + " keywords in " + path)
+
+
+# Scores a work item, and returns its partial hits: the delta of a ScoreAccumulator with the hits of its keywords
+# the documents are plain dicts, so they can be saved in the queue
+def score_work_item(item):
+    topic = item["topic"]
+    input_list = item["keywords"]
+    accumulator = ScoreAccumulator(TOPICS[topic]["prefix"])
+    
+    start = time.perf_counter()
+    
+    # the item is the unit of work, an interrupted item is scored again from its first keyword
+    progress = JobProgress(item["lang"], {topic: input_list}, {topic: accumulator}, saved=False)
+    score_keywords(topic, input_list, accumulator, progress)
+    
+    extended_logger.info("Scored " + topic + " (" + item["lang"] + ") keywords " + str(item["start"]) + "-"
+                         + str(item["start"] + len(input_list)) + " in " + format(time.perf_counter() - start, ".1f") + "s")
+    
+    keys, docs, columns, hit_rows, hit_columns = accumulator.delta()
+    
+    return keys, [dict(doc) for doc in docs], columns, hit_rows, hit_columns
+
+
+# Claims the work items of the queue at 'path' one by one, scores them and saves their partial hits
+# the lease of an item is renewed while it is being scored (see Heartbeat). Once nothing is left to claim,
+# it waits for the items other workers are scoring: if one of them dies, its item is claimed again when its lease expires
+# Returns the number of items scored by this worker
+def run_worker(path):
+    work_queue = WorkQueue(path, work_lease)
+    worker = socket.gethostname() + ":" + str(os.getpid())
+    done = 0
+    
+    try:
+        while True:
+            item = work_queue.claim(worker)
+            
+            if item is None:
+                if not work_queue.counts().get("claimed"):
+                    break
+                
+                time.sleep(min(5, work_lease))
+                continue
+            
+            try:
+                with Heartbeat(work_queue, item["id"], worker):
+                    partial = score_work_item(item)
+            except BaseException:
+                # the item goes back to the queue, for another worker or a later run
+                work_queue.release(item["id"])
+                raise
+            
+            work_queue.complete(item["id"], partial)
+            done = done + 1
+    finally:
+        work_queue.close()
+    
+    return done
+
+
+# Runs run_worker in a worker process, and also returns its metrics, to be merged in the parent process
+def run_worker_in_process(path):
+    done = run_worker(path)
+    
+    return done, metrics.snapshot()
+
+
+# Sharded scoring, step 2: scores the work items of the queue at 'path' with 'processes' worker processes
+# it can run on several hosts at the same time, as long as they share the queue file
+def work_command(path, processes):
+    global delta_filter
+    
+    work_queue = WorkQueue(path, work_lease)
+    queue_mode = work_queue.get_meta("scoring_mode")
+    delta_run = work_queue.get_meta("delta_run")
+    work_queue.close()
+    
+    # the hits of every item must be those of the scoring mode the reducer expects
+    if queue_mode != scoring_mode:
+        extended_logger.error("The work items of " + path + " are for \"" + str(queue_mode) + "\" scoring mode, not \""
+                              + scoring_mode + "\"")
+        return
+    
+    filter_query = delta_run["filter"] if delta_run is not None else None
+    
+    if processes <= 1:
+        delta_filter = filter_query
+        done = run_worker(path)
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(filter_query,)) as executor:
+            futures = [executor.submit(run_worker_in_process, path) for _ in range(processes)]
+            done = 0
+            
+            for future in as_completed(futures):
+                worker_done, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                done = done + worker_done
+    
+    extended_logger.info("Scored " + str(done) + " work items")
+    
+    log_stage_summary()
+    metrics.export(metrics_json_path, metrics_prometheus_path)
+
+
+# Sharded scoring, step 3: merges the partial hits of the work items of the queue at 'path' into the scored articles,
+# then uploads (or exports) them, the same as a run
+# items are merged in keyword order, so articles get the same scores and found keywords, in the same order, as in a single process
+def reduce_command(path):
+    global delta_filter
+    
+    work_queue = WorkQueue(path, work_lease)
+    counts = work_queue.counts()
+    remaining = sum(count for status, count in counts.items() if status != "done")
+    
+    if remaining:
+        extended_logger.error(str(remaining) + " of " + str(sum(counts.values())) + " work items of " + path
+                              + " are not scored yet, run the work command again")
+        work_queue.close()
+        return
+    
+    languages = work_queue.get_meta("languages")
+    
+    # stale scores are cleared with the filter of the incremental run the coordinator started
+    watermarks = None
+    delta_run = work_queue.get_meta("delta_run")
+    if delta_run is not None:
+        delta_filter = delta_run["filter"]
+        watermarks = delta_run["watermark"], delta_run["new_watermark"]
+    
+    uploader = create_uploader()
+    results = {lang: {} for lang in languages}
+    
+    for lang in languages:
+        for topic in TOPICS:
+            # spill files are named after the queue, instead of the keywords of a job
+            accumulator = ScoreAccumulator(TOPICS[topic]["prefix"], spill_path(lang, {topic: os.path.abspath(path)}, topic))
+            
+            with metrics.stage("reduce"):
+                for partial in work_queue.results(lang, topic):
+                    accumulator.merge(partial)
+            
+            metrics.inc("stage_items_total", accumulator.hits, stage="reduce")
+            
+            results[lang][topic] = finishTopicScoring(topic, accumulator, lang)
+            
+            if uploader is not None:
+                uploader.upload(results[lang][topic], lang, topic)
+    
+    work_queue.close()
+    
+    publish_results(results, languages, uploader, watermarks)
+    
+    log_stage_summary()
+    metrics.export(metrics_json_path, metrics_prometheus_path)
+
+
+# Compiles the on-disk link index of every topic of the given languages, so scoring runs only have to open it
+def index_command(languages):
+    for lang in languages:
+        for topic in TOPICS:
+            paths = topic_paths(topic, lang)
+            
+            if None in paths:
+                extended_logger.info("Skipping the " + topic + " (" + lang + ") link index, its CSV directories are not set")
+                continue
+            
+            start = time.perf_counter()
+            link_index = open_link_index(paths)
+            extended_logger.info("Link index of " + topic + " (" + lang + "): " + str(len(link_index)) + " links, "
+                                 + format(time.perf_counter() - start, ".1f") + "s")
+
+
+# Uploads the articles of JSON lines files written by the score command, to the collection of 'lang'
+# files written before the query was stored per topic are uploaded in the current schema
+def upload_command(lang, paths):
+    for path in paths:
+        with open(path, "r", encoding='utf-8') as input_file:
+            documents_list = [migrate_query_field(json.loads(line)) for line in input_file if line.strip()]
+        
+        upload_documents(documents_list, lang)
+        extended_logger.info("Uploaded " + path)
+    
+    upload_stats.log_summary()
+    log_stage_summary()
+    metrics.export(metrics_json_path, metrics_prometheus_path)
+
+
+# Moves the single "query" field of the articles stored before the query was stored per topic, to the <prefix>_query
+# field of every topic the article has a score for, and removes it. Articles that already have the field of a topic
+# keep it. Merged articles of several topics only kept the query of one of them, which is copied to all of them
+# until a full run scores the articles again
+def migrate_command(languages):
+    for lang in languages:
+        collection = get_collection(lang)
+        
+        for config in TOPICS.values():
+            prefix = config["prefix"]
+            result = collection.update_many({"query": {"$exists": True}, prefix + "_score": {"$exists": True},
+                                             prefix + "_query": {"$exists": False}},
+                                            [{"$set": {prefix + "_query": "$query"}}])
+            extended_logger.info("Migrated the " + prefix + " query of " + str(result.modified_count) + " articles (" + lang + ")")
+        
+        result = collection.update_many({"query": {"$exists": True}}, {"$unset": {"query": ""}})
+        extended_logger.info("Removed the query field of " + str(result.modified_count) + " articles (" + lang + ")")
+
+
+# Returns the parsed command line arguments
+# without a command, the whole run is done (score, upload and merge), the same as the "run" command
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Scores Solr articles by topic and uploads them to MongoDB")
+    commands = parser.add_subparsers(dest="command")
+    
+    run_parser = commands.add_parser("run", help="score, upload and merge (default)")
+    run_parser.add_argument("--lang", nargs="+", choices=["en", "es"], default=None,
+                            help="languages to score (default: SCORE_LANGUAGES)")
+    run_parser.add_argument("--resume", action="store_true", help="keep the progress of an interrupted run")
+    
+    score_parser = commands.add_parser("score", help="score articles and write them to JSON lines files")
+    score_parser.add_argument("--lang", nargs="+", choices=["en", "es"], default=None,
+                              help="languages to score (default: SCORE_LANGUAGES)")
+    score_parser.add_argument("--topic", nargs="+", choices=list(TOPICS), default=list(TOPICS),
+                              help="topics to score (default: all)")
+    score_parser.add_argument("--output", default=".", help="directory of the JSON lines files")
+    score_parser.add_argument("--resume", action="store_true", help="keep the progress of an interrupted run")
+    
+    upload_parser = commands.add_parser("upload", help="upload JSON lines files written by the score command")
+    upload_parser.add_argument("--lang", required=True, choices=["en", "es"])
+    upload_parser.add_argument("--input", nargs="+", required=True, help="JSON lines files to upload")
+    
+    commands.add_parser("merge", help="remove the duplicated articles from MongoDB")
+    
+    migrate_parser = commands.add_parser("migrate", help="move the query field of stored articles to the query field of each topic")
+    migrate_parser.add_argument("--lang", nargs="+", choices=["en", "es"], default=["en", "es"])
+    
+    import_parser = commands.add_parser("import", help="load the files of an export (OUTPUT_SINK=export) into MongoDB")
+    import_parser.add_argument("--input", default=export_dir, help="export directory (default: EXPORT_DIR)")
+    import_parser.add_argument("--lang", nargs="+", choices=["en", "es"], default=["en", "es"])
+    import_parser.add_argument("--topic", nargs="+", choices=list(TOPICS), default=list(TOPICS))
+    import_parser.add_argument("--workers", type=int, default=4, help="chunks loaded at the same time")
+    
+    index_parser = commands.add_parser("index", help="compile the CSV directories into the on-disk link index")
+    index_parser.add_argument("--lang", nargs="+", choices=["en", "es"], default=["en", "es"])
+    
+    coordinate_parser = commands.add_parser("coordinate", help="split the keywords into work items for sharded scoring")
+    coordinate_parser.add_argument("--lang", nargs="+", choices=["en", "es"], default=None,
+                                   help="languages to score (default: SCORE_LANGUAGES)")
+    coordinate_parser.add_argument("--queue", default=work_queue_path, help="work queue file (default: WORK_QUEUE)")
+    coordinate_parser.add_argument("--item-keywords", type=int, default=work_item_keywords,
+                                   help="keywords per work item (default: WORK_ITEM_KEYWORDS)")
+    
+    work_parser = commands.add_parser("work", help="score the work items of a queue made by the coordinate command")
+    work_parser.add_argument("--queue", default=work_queue_path, help="work queue file (default: WORK_QUEUE)")
+    work_parser.add_argument("--processes", type=int, default=1, help="worker processes on this host")
+    
+    reduce_parser = commands.add_parser("reduce", help="merge the scored work items of a queue, upload and merge")
+    reduce_parser.add_argument("--queue", default=work_queue_path, help="work queue file (default: WORK_QUEUE)")
+    
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    arguments = parse_arguments(argv)
+    
+    if arguments.command == "score":
+        score_command(arguments.lang or score_languages, arguments.topic, arguments.output, arguments.resume)
+    elif arguments.command == "upload":
+        upload_command(arguments.lang, arguments.input)
+    elif arguments.command == "merge":
+        merge_duplicates()
+    elif arguments.command == "migrate":
+        migrate_command(arguments.lang)
+    elif arguments.command == "import":
+        import_command(arguments.input, arguments.lang, arguments.topic, arguments.workers)
+    elif arguments.command == "index":
+        index_command(arguments.lang)
+    elif arguments.command == "coordinate":
+        coordinate_command(arguments.lang or score_languages, arguments.queue, arguments.item_keywords)
+    elif arguments.command == "work":
+        work_command(arguments.queue, arguments.processes)
+    elif arguments.command == "reduce":
+        reduce_command(arguments.queue)
+    else:
+        main(getattr(arguments, "lang", None), getattr(arguments, "resume", False))
 
 # ******************************************************************************************************** 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
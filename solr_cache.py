@@ -0,0 +1,82 @@
+import sqlite3
+import threading
+import time
+import zlib
+
+
+# Persistent cache of Solr responses, stored in a single SQLite file
+# Every entry keeps the version of the Solr index it was fetched from, entries of another version are stale
+# Entries older than 'ttl' seconds expire, and the oldest entries are removed once the file holds more than 'max_bytes'
+class SolrCache:
+
+    # number of writes between two eviction passes
+    evict_every = 100
+
+    def __init__(self, path, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # shared by the concurrent fetch workers, every access goes through the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                       key TEXT PRIMARY KEY,
+                                       version TEXT,
+                                       created REAL,
+                                       size INTEGER,
+                                       body BLOB)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+        self.evict()
+
+    # returns the cached response text for 'key', or None if it is missing, expired or from another index version
+    def get(self, key, version):
+        with self.lock:
+            row = self.connection.execute("SELECT version, created, body FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is None or row[0] != version or row[1] < time.time() - self.ttl:
+                self.misses = self.misses + 1
+                return None
+
+            self.hits = self.hits + 1
+
+        return zlib.decompress(row[2]).decode("utf-8")
+
+    # stores the response text for 'key'
+    def put(self, key, version, text):
+        body = zlib.compress(text.encode("utf-8"))
+
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                    (key, version, time.time(), len(body), body))
+            self.connection.commit()
+            self.writes = self.writes + 1
+
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    # removes the expired entries, and then the oldest ones until the cache fits in 'max_bytes'
+    def evict(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self.connection.execute("SELECT key, size FROM responses ORDER BY created").fetchall()
+                stale = []
+
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    total = total - size
+
+                self.connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,112 @@
+import codecs
+import csv
+import io
+import json
+import re
+
+
+# matches the start of the documents array of a Solr JSON response, e.g. "docs":[
+docs_start_pattern = re.compile(r'"docs"\s*:\s*\[')
+
+# matches the cursor mark that comes after the documents
+cursor_mark_pattern = re.compile(r'"nextCursorMark"\s*:\s*"([^"]*)"')
+
+
+# Decodes the documents of a Solr JSON response one by one, while the response is being downloaded
+# the whole response is never held as a single string, only the document being decoded
+# once iterated, 'next_cursor_mark' holds the cursor of the next page (None if the request had no cursor)
+# and 'bytes_received' the size of the response body
+class JsonDocStream:
+
+    chunk_size = 65536
+
+    def __init__(self, response):
+        self.chunks = response.iter_content(chunk_size=self.chunk_size)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+        self.next_cursor_mark = None
+        self.bytes_received = 0
+
+    # reads the next chunk into the buffer, returns False when there is nothing left
+    def read_chunk(self):
+        if self.finished:
+            return False
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.finished = True
+            self.buffer = self.buffer[self.position:] + self.decoder.decode(b"", final=True)
+        else:
+            self.bytes_received = self.bytes_received + len(chunk)
+            self.buffer = self.buffer[self.position:] + self.decoder.decode(chunk)
+
+        self.position = 0
+        return True
+
+    # moves the position to the next character that isn't whitespace or a comma, reading more if needed
+    def skip_separators(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n,":
+                self.position = self.position + 1
+
+            if self.position < len(self.buffer) or not self.read_chunk():
+                return
+
+    def __iter__(self):
+        # skip the response header, up to the documents array
+        match = docs_start_pattern.search(self.buffer)
+        while match is None:
+            if not self.read_chunk():
+                raise ValueError("Solr response has no documents array")
+            match = docs_start_pattern.search(self.buffer)
+
+        self.position = match.end()
+
+        while True:
+            self.skip_separators()
+
+            if self.position >= len(self.buffer):
+                raise ValueError("Solr response ended inside the documents array")
+
+            if self.buffer[self.position] == "]":
+                self.position = self.position + 1
+                break
+
+            # a document may be split across chunks, keep reading until it decodes
+            while True:
+                try:
+                    doc, end = self.json_decoder.raw_decode(self.buffer, self.position)
+                    break
+                except json.JSONDecodeError:
+                    if not self.read_chunk():
+                        raise
+
+            self.position = end
+            yield doc
+
+        # what comes after the documents is small, read it all to find the cursor mark
+        while self.read_chunk():
+            pass
+
+        match = cursor_mark_pattern.search(self.buffer, self.position)
+        if match is not None:
+            self.next_cursor_mark = match.group(1)
+
+
+# Decodes the documents of a Solr CSV response (wt=csv) one by one, while the response is being downloaded
+# every value comes back as a string, and empty values are left out, the same as missing fields in JSON
+def csv_documents(response):
+    response.raw.decode_content = True
+    # urllib3 closes the body once it has been read to the end, the TextIOWrapper would fail on its next read
+    response.raw.auto_close = False
+    reader = csv.DictReader(io.TextIOWrapper(response.raw, encoding="utf-8", newline=""))
+
+    try:
+        for row in reader:
+            yield {key: value for key, value in row.items() if value != ""}
+    finally:
+        # so the connection goes back to the pool
+        response.close()
@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+
+
+# Adaptive limit on the number of concurrent requests (AIMD)
+# every fast, successful response raises the limit a little (additive increase, about +1 per full window of
+# requests), a slow or failed response halves it (multiplicative decrease). Decreases are at most one per
+# 'target_latency' seconds, so a burst of slow responses from the same overload only halves the limit once
+class AdaptiveLimiter:
+
+    def __init__(self, maximum, target_latency, minimum=1):
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.target_latency = target_latency
+        self.limit = float(self.maximum)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    # waits until there is room for one more request
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+
+            self.in_flight = self.in_flight + 1
+
+    # frees the room of a request that took 'latency' seconds, and adjusts the limit
+    def release(self, latency, success):
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+
+            if not success or latency > self.target_latency:
+                now = time.monotonic()
+
+                if now - self.last_decrease >= self.target_latency:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+
+# Stops sending requests to a server that keeps failing
+# after 'failures' failed requests in a row the circuit opens, and requests wait for 'reset_timeout' seconds.
+# Then a single trial request goes through: if it succeeds the circuit closes, if it fails it opens again
+class CircuitBreaker:
+
+    def __init__(self, failures, reset_timeout):
+        self.failure_threshold = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    # returns 0 if a request can be sent now, otherwise the number of seconds to wait before asking again
+    def wait_time(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+
+            # the trial request is in flight, the others wait for its outcome
+            if self.trial:
+                return min(1.0, self.reset_timeout)
+
+            self.trial = True
+            return 0
+
+    # registers the outcome of a request. Returns True if the failure just opened the circuit
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                self.trial = False
+                return False
+
+            self.failures = self.failures + 1
+            was_closed = self.opened_at is None
+
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.trial = False
+                return was_closed
+
+            return False
+
+
+# Returns the time to wait before retry number 'attempt' (0 is the first retry), with "full jitter":
+# a random time between 0 and the exponential backoff, so clients that failed together don't retry together
+def backoff_delay(attempt, base, cap):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,77 @@
+import json
+import os
+
+
+# Append-only file of document bodies, one JSON document per line
+# the file is opened on first use: appended to if it holds documents of a resumed job, emptied otherwise
+class SpillFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.keep = False
+        self.file = None
+
+    # returns the offset of the document written at the end of the file
+    def append(self, doc):
+        if self.file is None:
+            self.file = open(self.path, "ab" if self.keep else "wb")
+
+        offset = self.file.tell()
+        self.file.write(json.dumps(doc, ensure_ascii=False).encode("utf-8") + b"\n")
+
+        return offset
+
+    # writes what is buffered to disk, a checkpoint may point to any document written so far
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    # writes what is buffered, so the documents can be read back
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Scored documents of a topic whose bodies are in a spill file
+# only the ids and the score state (score, found keywords and fields added later) are kept in memory,
+# every iteration reads the bodies back from the file, one by one
+# it can be sent to another process, as long as the file can be read from there
+class SpilledDocuments:
+
+    def __init__(self, path, offsets, ids, fields):
+        self.path = path
+        self.offsets = offsets
+        self.ids = ids
+        # field name -> list with the value of each document, None if the document doesn't have it
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # adds a field to the documents, with the value of each one (None leaves a document without it)
+    def set_field(self, name, values):
+        self.fields[name] = values
+
+    def __iter__(self):
+        if not self.offsets:
+            return
+
+        with open(self.path, "rb") as spill_file:
+            for index, offset in enumerate(self.offsets):
+                spill_file.seek(offset)
+                doc = json.loads(spill_file.readline())
+
+                for name, values in self.fields.items():
+                    if values[index] is not None:
+                        doc[name] = values[index]
+
+                yield doc
+
+    # removes the spill file, once the documents have been uploaded
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
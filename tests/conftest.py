@@ -0,0 +1,13 @@
+import importlib.util
+import logging
+import os
+import sys
+import types
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# the logs module is deployed next to score.py, outside this repository; a plain logger stands in for it here
+if importlib.util.find_spec("logs") is None:
+    sys.modules["logs"] = types.SimpleNamespace(extended_logger=logging.getLogger("score-tests"))
@@ -0,0 +1,168 @@
+import copy
+import csv
+import os
+import re
+
+import pytest
+
+import score
+
+
+# Fixture corpus: English and Spanish articles, some matching several keywords and several topics
+CORPUS = [
+    {"id": "https://news.example/en/1", "title": "One", "text": "climate change and global warming hit the coast"},
+    {"id": "https://news.example/en/2", "title": "Two", "text": "the covid vaccine rollout and climate policy"},
+    {"id": "https://news.example/en/3", "title": "Three", "text": "an immigrant family crossed the border"},
+    {"id": "https://news.example/en/4", "title": "Four", "text": "global warming, climate change, carbon tax"},
+    {"id": "https://news.example/en/5", "title": "Five", "text": "covid cases rise, vaccine mandates and border rules"},
+    {"id": "https://news.example/en/6", "title": "Six", "text": "nothing to see here"},
+    {"id": "https://news.example/es/1", "title": "Uno", "text": "cambio climático y calentamiento global"},
+    {"id": "https://news.example/es/2", "title": "Dos", "text": "la vacuna contra el covid llega a la frontera"},
+    {"id": "https://news.example/es/3", "title": "Tres", "text": "crisis migratoria en la frontera sur"},
+    {"id": "https://news.example/es/4", "title": "Cuatro", "text": "el cambio climático y la crisis migratoria"},
+]
+
+# keyword lines as in the keyword files: several words, stop words, repeated lines and lines with no match
+KEYWORDS = {
+    "climate": ["climate change", "global warming", "carbon tax", "climate", "cambio del climático", "climate change",
+                "sea level"],
+    "covid": ["covid vaccine", "covid", "vaccine mandates", "vacuna contra el covid", "covid"],
+    "immigration": ["immigrant", "border", "crisis migratoria", "frontera", "border", "asylum seeker"],
+}
+
+CSV_DIRECTORIES = {
+    "climate": {"en": ["CH_HOW", "CH_IS", "CH_WHAT"], "es": ["CH_AQ", "CH_CO", "CH_ES"]},
+    "covid": {"en": ["CV_SH", "CV_WA", "CV_WH"], "es": ["CV_DE", "CV_FU", "CV_QU"]},
+    "immigration": {"en": ["IM_AR", "IM_HO", "IM_IS"], "es": ["IM_CO", "IM_LA", "IM_RE"]},
+}
+
+
+# Solr stand-in: the documents whose text contains every text:" ... " clause of the query, as fresh copies
+def fake_solr_data(query):
+    clauses = [clause.strip() for clause in re.findall(r'text:\s*"([^"]*)"', query)]
+    return [copy.deepcopy(doc) for doc in CORPUS if all(clause in doc["text"] for clause in clauses)]
+
+
+# Writes the CSV directories of every topic and language: each article is listed in one directory of each topic,
+# some of them in a second one as well (the last directory wins)
+def write_csv_directories(root):
+    env = {}
+
+    for topic, languages in CSV_DIRECTORIES.items():
+        for lang, directories in languages.items():
+            for position, directory in enumerate(directories):
+                path = os.path.join(str(root), lang, directory)
+                os.makedirs(path)
+
+                links = [doc["id"] for index, doc in enumerate(CORPUS) if index % 3 == position or index % 4 == position]
+                with open(os.path.join(path, "links.csv"), "w", encoding="utf-8", newline="") as csv_file:
+                    writer = csv.writer(csv_file)
+                    writer.writerow(["link", "desc", "title"])
+                    for link in links:
+                        writer.writerow([link, "", ""])
+
+                env["path_" + lang.upper() + "_" + directory] = path
+
+    return env
+
+
+# The scoring loop of climateScoringV2 / covidScoringV2 / immigrationScoringV2 before the shared engine
+# (only the way each keyword line becomes a query differs between the three)
+def reference_scoring(input_list, prefix, query_from_item):
+    id_list = []
+    documents_list = []
+
+    for item in input_list:
+        documents = score.get_solr_data(query_from_item(item))
+
+        for doc in documents:
+            key_id = doc["id"]
+
+            if key_id not in id_list:
+                id_list.append(key_id)
+                doc[prefix + "_score"] = 1
+                doc[prefix + "_found_keywords"] = [item]
+                documents_list.append(doc)
+            else:
+                index = 0
+                for document in documents_list:
+                    if document["id"] == key_id:
+                        document[prefix + "_score"] = document[prefix + "_score"] + 1
+                        document[prefix + "_found_keywords"].append(item)
+                        documents_list[index] = document
+                    else:
+                        index = index + 1
+
+    return documents_list
+
+
+# The query field as the old functions added it: the name of the last directory whose CSV files list the link
+# (the old functions named it "query", it is now stored per topic, as <prefix>_query)
+def reference_query_field(documents_list, paths, prefix):
+    for doc in documents_list:
+        for path in paths:
+            for name in score.find_csv_filenames(path):
+                with open(os.path.join(path, name), "r", encoding="utf-8", newline="") as csv_file:
+                    links = [row["link"] for row in csv.DictReader(csv_file)]
+
+                if doc["id"] in links:
+                    doc[prefix + "_query"] = os.path.basename(path)
+
+    return documents_list
+
+
+# climate and covid lines are cleaned of stop words and turned into AND queries, immigration lines are phrase queries
+def reference_query(topic):
+    if topic == "immigration":
+        return lambda item: """text:" """ + item + """ " """
+
+    return lambda item: score.queryFromKeywordsList(score.keywordsCleaner(item.split(" ")))
+
+
+@pytest.fixture
+def scoring_setup(tmp_path, monkeypatch):
+    for name, path in write_csv_directories(tmp_path).items():
+        monkeypatch.setenv(name, path)
+
+    monkeypatch.setattr(score, "get_solr_data", fake_solr_data)
+    monkeypatch.setattr(score, "scoring_mode", "keyword")
+    monkeypatch.setattr(score, "solr_workers", 1)
+    monkeypatch.setattr(score, "solr_page_size", 0)
+    monkeypatch.setattr(score, "checkpoint_every", 0)
+    monkeypatch.setattr(score, "spill_dir", "")
+    monkeypatch.setattr(score, "compact_records", False)
+    monkeypatch.setattr(score, "score_threshold", 0)
+    monkeypatch.setattr(score, "score_top_n", 0)
+    monkeypatch.setattr(score, "keyword_weights_path", "")
+    monkeypatch.setattr(score, "keyword_weights", None)
+    monkeypatch.setattr(score, "link_index_mode", "memory")
+    monkeypatch.setattr(score, "link_indexes", {})
+    monkeypatch.setattr(score, "query_plan", None)
+
+
+@pytest.mark.parametrize("lang", ["en", "es"])
+@pytest.mark.parametrize("topic", ["climate", "covid", "immigration"])
+def test_topic_scoring_matches_reference(scoring_setup, topic, lang):
+    expected = reference_scoring(KEYWORDS[topic], topic, reference_query(topic))
+    expected = reference_query_field(expected, score.topic_paths(topic, lang), topic)
+
+    scored = [dict(doc) for doc in score.topicScoring(topic, list(KEYWORDS[topic]), lang)]
+
+    assert expected
+    assert scored == expected
+    assert [doc["id"] for doc in scored] == [doc["id"] for doc in expected]
+
+
+@pytest.mark.parametrize("lang", ["en", "es"])
+def test_topic_wrappers_match_reference(scoring_setup, lang):
+    scorers = {
+        "climate": score.climateScoringV2,
+        "covid": score.covidScoringV2,
+        "immigration": score.immigrationScoringV2,
+    }
+
+    for topic, scorer in scorers.items():
+        expected = reference_scoring(KEYWORDS[topic], topic, reference_query(topic))
+        expected = reference_query_field(expected, score.topic_paths(topic, lang), topic)
+
+        assert [dict(doc) for doc in scorer(list(KEYWORDS[topic]), lang)] == expected
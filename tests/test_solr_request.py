@@ -0,0 +1,87 @@
+import io
+import json
+import types
+
+import pytest
+import requests
+
+import score
+
+
+DOCS = [{"id": "https://news.example/1", "title": "One"}]
+
+
+def solr_response(status_code, body):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode("utf-8")
+    response.raw = io.BytesIO(response._content)
+    response.url = "http://solr.example/solr/core/select"
+    return response
+
+
+# Solr stand-in that answers every attempt with the next of 'responses' (the last one once they run out),
+# and the response cache, in memory
+@pytest.fixture
+def solr(monkeypatch):
+    attempts = []
+    cached = {}
+
+    def answer(responses):
+        def send_solr_attempt(solr_params, post, stream):
+            attempts.append(solr_params)
+            return responses[min(len(attempts), len(responses)) - 1]
+
+        monkeypatch.setattr(score, "send_solr_attempt", send_solr_attempt)
+        return attempts
+
+    cache = types.SimpleNamespace(get=lambda key, version: cached.get(key), put=lambda key, version, text: cached.__setitem__(key, text))
+
+    monkeypatch.setattr(score, "solr_url", "http://solr.example/solr/core/select")
+    monkeypatch.setattr(score, "solr_retries", 2)
+    monkeypatch.setattr(score, "solr_backoff", 0)
+    monkeypatch.setattr(score, "solr_limiter", score.AdaptiveLimiter(1, 10))
+    monkeypatch.setattr(score, "solr_breaker", score.CircuitBreaker(100, 0))
+    monkeypatch.setattr(score, "solr_cache_mode", "on")
+    monkeypatch.setattr(score, "solr_cache", cache)
+    monkeypatch.setattr(score, "index_version", "1")
+    monkeypatch.setattr(score, "solr_response_format", "json")
+    monkeypatch.setattr(score, "delta_filter", None)
+
+    answer.cached = cached
+    return answer
+
+
+def test_solr_down_after_every_retry_raises_solr_unavailable(solr):
+    unavailable = solr_response(503, {"error": {"msg": "Service Unavailable", "code": 503}})
+    attempts = solr([unavailable])
+
+    with pytest.raises(score.SolrUnavailableError, match="HTTP 503"):
+        score.get_solr_data('text:" climate "')
+
+    assert len(attempts) == 3
+    assert solr.cached == {}
+
+
+def test_query_syntax_error_raises_http_error(solr):
+    attempts = solr([solr_response(400, {"error": {"msg": "org.apache.solr.search.SyntaxError", "code": 400}})])
+
+    with pytest.raises(requests.HTTPError):
+        score.get_solr_data('text:" climate ')
+
+    # a client error isn't retried
+    assert len(attempts) == 1
+    assert solr.cached == {}
+
+
+def test_successful_retry_returns_and_caches_the_documents(solr):
+    attempts = solr([solr_response(503, {"error": {"code": 503}}),
+                     solr_response(200, {"response": {"numFound": 1, "start": 0, "docs": DOCS}})])
+
+    assert score.get_solr_data('text:" climate "') == DOCS
+    assert len(attempts) == 2
+    assert len(solr.cached) == 1
+
+    # answered from the cache
+    assert score.get_solr_data('text:" climate "') == DOCS
+    assert len(attempts) == 2
@@ -0,0 +1,79 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from solr_stream import JsonDocStream, csv_documents
+
+
+CSV_BODY = ('id,title,timestamp\n'
+            'https://news.example/1,One,1\n'
+            'https://news.example/2,"Two, with a comma",2\n'
+            'https://news.example/3,"Three ""quoted""\nand on two lines",3\n'
+            'https://news.example/4,,4\n'
+            'https://news.example/5,Cinco ñ,5\n')
+
+JSON_DOCS = [{"id": "https://news.example/" + str(index), "title": "Doc " + str(index)} for index in range(200)]
+JSON_BODY = json.dumps({"responseHeader": {"status": 0},
+                        "response": {"numFound": len(JSON_DOCS), "start": 0, "docs": JSON_DOCS},
+                        "nextCursorMark": "AoE"})
+
+
+# Answers every request with the canned body of its path, over a real socket: urllib3 closes the body
+# of a real response once it has been read to the end, which a response built in memory doesn't do
+class CannedHandler(BaseHTTPRequestHandler):
+
+    bodies = {"/csv": ("text/csv", CSV_BODY), "/json": ("application/json", JSON_BODY)}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        content_type, text = self.bodies[self.path]
+        body = text.encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="module")
+def canned_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CannedHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield "http://127.0.0.1:" + str(server.server_address[1])
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_csv_documents_decodes_a_streamed_response(canned_url):
+    with requests.Session() as session:
+        # twice on the same session, the connection goes back to the pool after the first response
+        for _ in range(2):
+            documents = list(csv_documents(session.get(canned_url + "/csv", stream=True)))
+
+            assert documents == [
+                {"id": "https://news.example/1", "title": "One", "timestamp": "1"},
+                {"id": "https://news.example/2", "title": "Two, with a comma", "timestamp": "2"},
+                {"id": "https://news.example/3", "title": 'Three "quoted"\nand on two lines', "timestamp": "3"},
+                {"id": "https://news.example/4", "timestamp": "4"},
+                {"id": "https://news.example/5", "title": "Cinco ñ", "timestamp": "5"},
+            ]
+
+
+def test_json_doc_stream_decodes_a_streamed_response(canned_url, monkeypatch):
+    # small chunks, so documents are split across them
+    monkeypatch.setattr(JsonDocStream, "chunk_size", 64)
+
+    stream = JsonDocStream(requests.get(canned_url + "/json", stream=True))
+
+    assert list(stream) == JSON_DOCS
+    assert stream.next_cursor_mark == "AoE"
+    assert stream.bytes_received == len(JSON_BODY.encode("utf-8"))
@@ -0,0 +1,153 @@
+import json
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+
+# Durable queue of scoring work items, stored in a single SQLite file
+# An item is a shard of the keywords of a topic of a language. Workers claim items, and write the partial
+# hits of each one when it is done. A claimed item that isn't done within 'lease' seconds (its worker died)
+# can be claimed again; while a worker scores an item, a Heartbeat keeps renewing its lease.
+# Workers on several hosts can share the file, if it is on storage with working file locks
+class WorkQueue:
+
+    def __init__(self, path, lease=600):
+        self.path = path
+        self.lease = lease
+
+        # transactions are started explicitly, claims need an exclusive one
+        # WAL needs memory shared between the processes of a single host, the queue may be on a network filesystem:
+        # the rollback journal only relies on file locks
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS items (
+                                       id INTEGER PRIMARY KEY,
+                                       lang TEXT,
+                                       topic TEXT,
+                                       start INTEGER,
+                                       keywords TEXT,
+                                       status TEXT,
+                                       worker TEXT,
+                                       claimed REAL,
+                                       attempts INTEGER)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                                       item INTEGER PRIMARY KEY,
+                                       body BLOB)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS meta (
+                                       key TEXT PRIMARY KEY,
+                                       value TEXT)""")
+
+    # replaces the content of the queue with new items, each one a (lang, topic, start, keywords) tuple,
+    # and the metadata of the run
+    def create(self, items, meta):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("DELETE FROM items")
+            self.connection.execute("DELETE FROM results")
+            self.connection.execute("DELETE FROM meta")
+            self.connection.executemany("INSERT INTO items (lang, topic, start, keywords, status, attempts) VALUES (?, ?, ?, ?, 'pending', 0)",
+                                        [(lang, topic, start, json.dumps(keywords)) for lang, topic, start, keywords in items])
+            self.connection.executemany("INSERT INTO meta VALUES (?, ?)", [(key, json.dumps(value)) for key, value in meta.items()])
+
+    # returns the value saved for 'key' in the metadata of the run, or None
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    # claims the next item that is pending, or whose lease expired, for 'worker'
+    # returns it as a dict, or None if there is nothing left to claim right now
+    def claim(self, worker):
+        now = time.time()
+
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("""SELECT id, lang, topic, start, keywords FROM items
+                                             WHERE status = 'pending' OR (status = 'claimed' AND claimed < ?)
+                                             ORDER BY id LIMIT 1""", (now - self.lease,)).fetchone()
+
+            if row is None:
+                return None
+
+            self.connection.execute("UPDATE items SET status = 'claimed', worker = ?, claimed = ?, attempts = attempts + 1 WHERE id = ?",
+                                    (worker, now, row[0]))
+
+        return {"id": row[0], "lang": row[1], "topic": row[2], "start": row[3], "keywords": json.loads(row[4])}
+
+    # extends the lease of an item that 'worker' is still scoring
+    # returns False if the item is no longer claimed by it (its lease expired and another worker claimed it)
+    def renew(self, item_id, worker):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            cursor = self.connection.execute("UPDATE items SET claimed = ? WHERE id = ? AND worker = ? AND status = 'claimed'",
+                                             (time.time(), item_id, worker))
+
+        return cursor.rowcount > 0
+
+    # saves the partial hits of an item, and marks it as done
+    # if two workers did the same item (an expired lease), the first result is kept, both are the same
+    def complete(self, item_id, partial):
+        body = zlib.compress(pickle.dumps(partial, protocol=pickle.HIGHEST_PROTOCOL))
+
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("INSERT OR IGNORE INTO results VALUES (?, ?)", (item_id, body))
+            self.connection.execute("UPDATE items SET status = 'done' WHERE id = ?", (item_id,))
+
+    # gives an item back, so another worker can claim it
+    def release(self, item_id):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("UPDATE items SET status = 'pending', worker = NULL WHERE id = ? AND status = 'claimed'", (item_id,))
+
+    # returns the number of items in each status
+    def counts(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+
+    # yields the partial hits of the items of a topic of a language, in keyword order
+    def results(self, lang, topic):
+        rows = self.connection.execute("""SELECT results.body FROM items JOIN results ON results.item = items.id
+                                          WHERE items.lang = ? AND items.topic = ? ORDER BY items.start""", (lang, topic))
+
+        for (body,) in rows:
+            yield pickle.loads(zlib.decompress(body))
+
+    def close(self):
+        self.connection.close()
+
+
+# Renews the lease of an item from a background thread, while the item is being scored
+# the lease is renewed three times per lease period, so an item that takes longer than the lease isn't claimed
+# again by other workers as long as its worker is alive
+class Heartbeat:
+
+    def __init__(self, work_queue, item_id, worker):
+        self.path = work_queue.path
+        self.lease = work_queue.lease
+        self.item_id = item_id
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    # SQLite connections belong to the thread that opened them, the heartbeat opens its own
+    def run(self):
+        work_queue = WorkQueue(self.path, self.lease)
+
+        try:
+            while not self.stopped.wait(self.lease / 3):
+                work_queue.renew(self.item_id, self.worker)
+        finally:
+            work_queue.close()